@@ -2,10 +2,15 @@
 
 # Created on 3/6/2020, by Robin, robin@naturewake.com
 import argparse
+import atexit
 from lib.container_builder import build_containers
+from lib.container_builder import sync_containers
 from lib.db_builder import create_postgres_databases
+from lib.db_builder import reset_postgres_databases
 from lib.image_builder import build_images
 from lib.network_builder import create_networks
+from lib.tracing import enable_tracing
+from lib.tracing import write_trace
 
 # Execute from the command line
 if __name__ == "__main__":
@@ -15,21 +20,43 @@ if __name__ == "__main__":
     argParser.add_argument('--create-networks', type=str, required=False, help='Create a custom network according to a configuration file, which in JSON format with all network settings')
     argParser.add_argument('--build-containers', type=str, required=False,
         help='Build container instances according to a configuration file, which in JSON format with all container settings')
-    argParser.add_argument('--create-postgres-db', type=str, required=False,
-        help='Build databases in container instances according to a configuration file, which in JSON format with all container settings')
+    argParser.add_argument('--sync-containers', type=str, required=False,
+        help='Synchronize changed source files to running container instances according to a configuration file, without rebuilding them')
+    argParser.add_argument('--create-postgres-db', nargs="+", type=str, required=False,
+        help='Build databases in container instances according to configuration files, which in JSON format with all container settings, seperated by space')
+    argParser.add_argument('--snapshot-db', action='store_true', required=False,
+        help='with --create-postgres-db, save the created databases as templates for --reset-db')
+    argParser.add_argument('--reset-db', nargs="+", type=str, required=False,
+        help='Drop the databases in configuration files and clone them from their templates saved by --snapshot-db, seperated by space')
+    argParser.add_argument('--db-ready-timeout', type=float, required=False, default=180,
+        help='seconds to wait for postgres in the containers to accept connections before creating or resetting databases')
     argParser.add_argument('--hosts', nargs="+", type=str, required=False, help="target host list, seperated by ','")
     argParser.add_argument('--ignoreCmdErr', type=bool, required=False, default=True, help="if set false, stop custom commands if an error occure")
+    argParser.add_argument('--max-parallel', type=int, required=False, default=1, help="maximum number of images or containers to build at the same time")
+    argParser.add_argument('--force-build-images', action='store_true', required=False, help="rebuild the images even if their dockerfiles are unchanged")
+    argParser.add_argument('--prebaked-ssh', action='store_true', required=False, help="generate ssh keypairs of the containers on the host once and put them into the containers when building them")
+    argParser.add_argument('--no-cache', action='store_true', required=False, help="rebuild all containers even if their configuration and sources are unchanged")
+    argParser.add_argument('--trace-file', type=str, required=False, help="a json file to write the spans of the functions and docker calls to, in Chrome trace event format")
     args = argParser.parse_args()
+    if args.trace_file is not None:
+        enable_tracing()
+        atexit.register(write_trace, args.trace_file)
 
     if args.build_images is not None:
-        build_images(args.build_images)
+        build_images(args.build_images, maxParallel = args.max_parallel, force = args.force_build_images)
     
     if args.create_networks is not None:
         create_networks(args.create_networks)
 
     if args.build_containers is not None:
-        build_containers(args.build_containers, hosts = args.hosts, ignoreCmdErr = args.ignoreCmdErr)
+        build_containers(args.build_containers, hosts = args.hosts, ignoreCmdErr = args.ignoreCmdErr, maxParallel = args.max_parallel, useCache = not args.no_cache, prebakedSsh = args.prebaked_ssh)
+
+    if args.sync_containers is not None:
+        sync_containers(args.sync_containers, hosts = args.hosts)
 
     if args.create_postgres_db is not None:
-        create_postgres_databases(args.create_postgres_db)
+        create_postgres_databases(args.create_postgres_db, snapshot = args.snapshot_db, readyTimeout = args.db_ready_timeout)
+
+    if args.reset_db is not None:
+        reset_postgres_databases(args.reset_db, readyTimeout = args.db_ready_timeout)
 
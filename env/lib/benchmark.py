@@ -0,0 +1,162 @@
+# module for benchmarking the orchestration by the timings of its tasks
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+BenchmarkVersion = 1
+# phases in the order of the orchestration, a task belongs to the phase before ':' in its name
+Phases = ["networks", "images", "container", "commit", "ssh-trust", "database", "repository", "agent", "services", "load"]
+
+def get_phase(taskName: str = None):
+    return taskName.split(':', 1)[0]
+
+def summarize_timings(timings: dict = None):
+    """Summarize the timings of one run, see scheduler.run_tasks
+
+    return a dictionary of "total" wall time, "phases" with the wall time from the first task
+    begun to the last task finished of each phase, and "tasks" with the duration of each task
+    """
+    if timings is None or len(timings) == 0:
+        return {"total": 0, "phases": {}, "tasks": {}}
+    phases = {}
+    for name in timings:
+        phase = get_phase(name)
+        (taskBegin, taskEnd) = timings[name]
+        if phase not in phases:
+            phases[phase] = [taskBegin, taskEnd]
+        else:
+            phases[phase] = [min(phases[phase][0], taskBegin), max(phases[phase][1], taskEnd)]
+    return {
+        "total": max([x[1] for x in timings.values()]) - min([x[0] for x in timings.values()]),
+        "phases": {phase: phases[phase][1] - phases[phase][0] for phase in phases},
+        "tasks": {name: timings[name][1] - timings[name][0] for name in timings}
+    }
+
+def get_metrics(run: dict = None):
+    """Flatten a summarized run to a dictionary of metric name and seconds
+    """
+    metrics = {"total": run["total"]}
+    for phase in run["phases"]:
+        metrics["phase:{}".format(phase)] = run["phases"][phase]
+    for name in run["tasks"]:
+        metrics["task:{}".format(name)] = run["tasks"][name]
+    return metrics
+
+def aggregate_runs(runs: list = None):
+    """return a dictionary of metric name and its min, median, mean and max over the runs
+    """
+    values = {}
+    for run in runs or []:
+        metrics = get_metrics(run)
+        for name in metrics:
+            values.setdefault(name, []).append(metrics[name])
+    result = {}
+    for name in values:
+        result[name] = {
+            "runs": len(values[name]),
+            "min": min(values[name]),
+            "median": statistics.median(values[name]),
+            "mean": statistics.mean(values[name]),
+            "max": max(values[name])
+        }
+    return result
+
+def get_revision(path: str = None):
+    """return the git commit of the path, or None if it's not in a git repository
+    """
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd = path or os.getcwd(),
+            stdout = subprocess.PIPE,
+            stderr = subprocess.DEVNULL
+        )
+        if output.returncode == 0:
+            return output.stdout.decode("utf8").strip()
+    except Exception:
+        pass
+    return None
+
+def build_results(runs: list = None, phases: list = None, options: dict = None):
+    """return the benchmark results to save, which contain the runs and their summary
+    """
+    return {
+        "version": BenchmarkVersion,
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": get_revision(os.path.dirname(os.path.abspath(__file__))),
+        "host": platform.node(),
+        "phases": phases,
+        "options": options or {},
+        "runs": runs,
+        "summary": aggregate_runs(runs)
+    }
+
+def save_results(results: dict = None, resultsFile: str = None):
+    with open(resultsFile, 'w') as f:
+        json.dump(results, f, indent = 2)
+    print('benchmark results have been written to', resultsFile)
+
+def load_results(resultsFile: str = None):
+    """Load benchmark results saved by save_results, None if the file does not exist
+    """
+    if resultsFile is None or not os.path.exists(resultsFile):
+        return None
+    with open(resultsFile) as f:
+        results = json.load(f)
+    if "version" not in results or results["version"] != BenchmarkVersion:
+        raise Exception('benchmark results {} are in version {}, but version {} is expected'.format(
+            resultsFile, results.get("version"), BenchmarkVersion
+        ))
+    return results
+
+def compare_with_baseline(results: dict = None, baseline: dict = None, threshold: float = 0.2, minDelta: float = 1):
+    """Compare the medians of the total and phase metrics with the baseline
+
+    return a list of regressions, each is a dictionary of metric, baseline, current and ratio,
+    a metric regresses if it is slower than the baseline by more than threshold
+    and by more than minDelta seconds
+    """
+    regressions = []
+    if baseline is None:
+        return regressions
+    for name in results["summary"]:
+        if name.startswith("task:") or name not in baseline["summary"]:
+            continue
+        previous = baseline["summary"][name]["median"]
+        current = results["summary"][name]["median"]
+        if current - previous > minDelta and current > previous * (1 + threshold):
+            regressions.append({
+                "metric": name,
+                "baseline": previous,
+                "current": current,
+                "ratio": current / previous if previous > 0 else None
+            })
+    return regressions
+
+def print_benchmark_report(results: dict = None, baseline: dict = None, regressions: list = None):
+    """Print the medians of the metrics, compared with the baseline if any
+    """
+    summary = results["summary"]
+    print("")
+    print("benchmark of {} runs (seconds, median [min - max]):".format(len(results["runs"])))
+    names = ["total"] + ["phase:{}".format(p) for p in Phases if "phase:{}".format(p) in summary]
+    names += sorted([n for n in summary if n.startswith("phase:") and n not in names])
+    names += sorted([n for n in summary if n.startswith("task:")])
+    regressed = set([r["metric"] for r in regressions or []])
+    for name in names:
+        s = summary[name]
+        line = "    {:<48} {:>8} [{} - {}]".format(name, round(s["median"], 2), round(s["min"], 2), round(s["max"], 2))
+        if baseline is not None and name in baseline["summary"]:
+            line += "  baseline: {}".format(round(baseline["summary"][name]["median"], 2))
+        if name in regressed:
+            line += "  REGRESSION"
+        print(line)
+    if baseline is not None:
+        print("compared with the baseline of revision {} created at {}".format(baseline.get("revision"), baseline.get("createdAt")))
+        if regressions is not None and len(regressions) > 0:
+            print("{} metrics regressed".format(len(regressions)))
+        else:
+            print("no regression")
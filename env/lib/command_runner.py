@@ -0,0 +1,150 @@
+# module for executing commands in containers with streamed output
+import math
+import threading
+import time
+if __name__ == "lib.command_runner":
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.docker_client import get_client
+    from lib.tracing import traced
+    from lib.tracing import current_span
+else:
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.docker_client import get_client
+    from env.lib.tracing import traced
+    from env.lib.tracing import current_span
+
+@traced("run_command", ["container", "cmd"])
+def run_command(
+    container,
+    cmd: str = None,
+    workdir: str = "/",
+    environment = None,
+    timeout: float = None,
+    user: str = "",
+    prefix: str = None,
+    quiet: bool = False
+):
+    """Execute a command in the container, print its output line by line as it comes
+
+    If timeout is set, the command is run under 'timeout' in the container and given up
+    a few seconds after the deadline.
+
+    return a dictionary of host, cmd, workdir, begin, end, duration, bytes, exitCode and timedOut
+    """
+    if prefix is None:
+        prefix = container.name
+    execCmd = cmd
+    if timeout is not None:
+        execCmd = ["timeout", "-s", "KILL", str(max(1, math.ceil(timeout))), "sh", "-c", cmd]
+    result = {
+        "host": container.name,
+        "cmd": cmd,
+        "workdir": workdir,
+        "begin": time.time(),
+        "end": None,
+        "duration": None,
+        "bytes": 0,
+        "exitCode": None,
+        "timedOut": False
+    }
+    client = get_client()
+    execId = client.api.exec_create(
+        container.id,
+        execCmd,
+        workdir = workdir,
+        environment = environment,
+        user = user
+    )["Id"]
+    output = client.api.exec_start(execId, stream = True)
+
+    def reader():
+        pending = b''
+        for chunk in output:
+            result["bytes"] += len(chunk)
+            if quiet:
+                continue
+            pending += chunk
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                print_with_prefix(prefix, line.decode("utf8", errors = "replace").rstrip('\r'))
+        if pending and not quiet:
+            print_with_prefix(prefix, pending.decode("utf8", errors = "replace"))
+    thread = threading.Thread(target = reader, daemon = True)
+    thread.start()
+    thread.join(None if timeout is None else timeout + 5)
+    if thread.is_alive():
+        result["timedOut"] = True
+    else:
+        result["exitCode"] = client.api.exec_inspect(execId)["ExitCode"]
+        # exit code of KILL signal given by 'timeout'
+        if timeout is not None and result["exitCode"] == 137:
+            result["timedOut"] = True
+    result["end"] = time.time()
+    result["duration"] = result["end"] - result["begin"]
+    current_span().set("bytes", result["bytes"])
+    current_span().set("exitCode", result["exitCode"])
+    return result
+
+def run_commands(
+    container,
+    commandList: list = None,
+    workdir: str = "/",
+    environment = None,
+    timeout: float = None,
+    ignoreCmdErr: bool = False,
+    prefix: str = None
+):
+    """Execute a list of commands in the container
+
+    A command is a string, or a dictionary with "cmd", and optional "timeout" and "independent".
+    Consecutive commands marked as independent run concurrently, others run one by one.
+    Unless ignoreCmdErr, it stops at the first failed command.
+
+    return a list of results of run_command, in the order of the command list
+    """
+    if prefix is None:
+        prefix = container.name
+    # group consecutive independent commands
+    groups = []
+    for item in commandList:
+        if type(item) == dict:
+            command = item
+        else:
+            command = {"cmd": item}
+        independent = "independent" in command and command["independent"] == True
+        if independent and len(groups) > 0 and groups[-1][0]:
+            groups[-1][1].append(command)
+        else:
+            groups.append((independent, [command]))
+
+    results = []
+    for (independent, commands) in groups:
+        tasks = {}
+        for i in range(len(commands)):
+            command = commands[i]
+            cmdTimeout = timeout
+            if "timeout" in command:
+                cmdTimeout = command["timeout"]
+            def task(command = command, cmdTimeout = cmdTimeout):
+                print_with_prefix(prefix, "[{}:{}/{}] command execution started at <{}>...".format(container.name, workdir, command["cmd"], time.ctime()))
+                result = run_command(container, command["cmd"], workdir, environment, cmdTimeout, prefix = prefix)
+                status = "exit code: {}".format(result["exitCode"])
+                if result["timedOut"]:
+                    status = "timeout after {} seconds".format(cmdTimeout)
+                print_with_prefix(prefix, "[{}:{}/{}] command execution finished in {} seconds with {}\n".format(
+                    container.name, workdir, command["cmd"], round(result["duration"], 1), status
+                ))
+                return result
+            tasks[i] = task
+        groupResults = run_tasks(tasks, None, len(tasks))
+        failed = False
+        for i in range(len(commands)):
+            results.append(groupResults[i])
+            if groupResults[i]["timedOut"] or groupResults[i]["exitCode"] != 0:
+                failed = True
+        if failed and not ignoreCmdErr:
+            break
+    return results
@@ -1,28 +1,375 @@
 # module for building containers
+import hashlib
 import json
 import os
 import time
-import docker
 import sys
 if __name__ == "lib.container_builder":
     from lib.utils import setup_ssh
-    from lib.utils import copy_to_container
+    from lib.utils import get_ssh_pub_key
+    from lib.utils import sync_to_container
+    from lib.command_runner import run_commands
     from lib.utils import build_ssh_trust_relationships
+    from lib.ssh_keys import get_ssh_keypairs
+    from lib.ssh_keys import install_prebaked_ssh
+    from lib.ssh_keys import spread_prebaked_ssh_keys
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.tracing import traced
+    from lib.path_filter import get_source_filter
+    from lib.path_filter import walk_source
+    from lib.docker_client import get_client
+    from lib.docker_client import get_image
+    from lib.docker_client import get_images
+    from lib.docker_client import get_network
+    from lib.docker_client import get_networks
+    from lib.docker_client import get_containers
+    from lib.docker_client import register_container
+    from lib.docker_client import forget_container
+    from lib.docker_client import register_image
+    from lib.docker_client import forget_image
 else:
     from env.lib.utils import setup_ssh
-    from env.lib.utils import copy_to_container
+    from env.lib.utils import get_ssh_pub_key
+    from env.lib.utils import sync_to_container
+    from env.lib.command_runner import run_commands
     from env.lib.utils import build_ssh_trust_relationships
+    from env.lib.ssh_keys import get_ssh_keypairs
+    from env.lib.ssh_keys import install_prebaked_ssh
+    from env.lib.ssh_keys import spread_prebaked_ssh_keys
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.tracing import traced
+    from env.lib.path_filter import get_source_filter
+    from env.lib.path_filter import walk_source
+    from env.lib.docker_client import get_client
+    from env.lib.docker_client import get_image
+    from env.lib.docker_client import get_images
+    from env.lib.docker_client import get_network
+    from env.lib.docker_client import get_networks
+    from env.lib.docker_client import get_containers
+    from env.lib.docker_client import register_container
+    from env.lib.docker_client import forget_container
+    from env.lib.docker_client import register_image
+    from env.lib.docker_client import forget_image
 
-client = docker.from_env()
+FingerprintLabel = "sardines.provision.fingerprint"
+CacheRepository = "sardines-cache"
 
-def build_containers(
-    containerConfFile:str = None, 
-    configuration: dict = None, 
-    baseDir: str = None, 
+def get_container_fingerprint(config: dict = None, extraHosts: dict = None, sshKeypair: dict = None):
+    """Fingerprint the effective configuration of a container, its base image,
+    the copied sources (paths, sizes and mtimes) and the command list
+
+    sshKeypair: the prebaked keypairs of the container, see ssh_keys.get_ssh_keypairs,
+    so a container is rebuilt when it switches to or from prebaked keys, or its keys change
+    """
+    h = hashlib.sha256()
+    effective = {}
+    for key in config:
+        if key not in ["commit", "dependsOn"]:
+            effective[key] = config[key]
+    h.update(json.dumps(effective, sort_keys = True).encode('utf8'))
+    h.update(json.dumps(extraHosts, sort_keys = True).encode('utf8'))
+    if sshKeypair is not None:
+        h.update(json.dumps({
+            "prebakedSsh": True,
+            "user": sshKeypair["user"]["public"],
+            "host": sshKeypair["host"]["public"]
+        }, sort_keys = True).encode('utf8'))
+    img = get_image(config["image"])
+    if img is not None:
+        h.update(img.id.encode('utf8'))
+    else:
+        h.update(config["image"].encode('utf8'))
+    if "copy" in config:
+        for copy in config["copy"]:
+            if "source" not in copy or not os.path.isdir(copy["source"]):
+                continue
+            filterList = None
+            if "filter" in copy:
+                filterList = copy["filter"]
+            ignoreFile = None
+            if "ignoreFile" in copy:
+                ignoreFile = copy["ignoreFile"]
+            excluded = get_source_filter(copy["source"], filterList, ignoreFile)
+            for (rel, isDir) in walk_source(copy["source"], excluded):
+                st = os.lstat(os.path.join(copy["source"], rel))
+                h.update("{}\0{}\0{}\n".format(rel, st.st_size, st.st_mtime).encode('utf8'))
+    return h.hexdigest()
+
+def get_commit_tag(config: dict = None):
+    """Return the image tag which the container will be committed to, or None
+    """
+    if config is None or "commit" not in config:
+        return None
+    if "image" in config["commit"] and "tag" in config["commit"]:
+        return "{}:{}".format(config["commit"]["image"], config["commit"]["tag"])
+    return None
+
+def get_container_dependencies(configList: list = None):
+    """Infer the dependencies between containers from the configuration list
+
+    A container depends on another one if its image is committed from that container,
+    or if the other hostname is listed in its optional "dependsOn" property
+    """
+    dependencies = {}
+    if configList is None:
+        return dependencies
+    commitCache = {}
+    for config in configList:
+        tag = get_commit_tag(config)
+        if tag is not None:
+            commitCache[tag] = config["hostname"]
+    for config in configList:
+        hostname = config["hostname"]
+        dependencies[hostname] = set()
+        if "image" in config and config["image"] in commitCache and commitCache[config["image"]] != hostname:
+            dependencies[hostname].add(commitCache[config["image"]])
+        if "dependsOn" in config and type(config["dependsOn"]) == list:
+            for dep in config["dependsOn"]:
+                if dep != hostname:
+                    dependencies[hostname].add(dep)
+    return dependencies
+
+@traced("commit_container", ["inst", "tag"])
+def commit_container(inst, tag: str = None, imageCache: dict = None):
+    """Commit the container instance to an image with the tag, replace the existing one
+    """
+    if inst is None or tag is None:
+        return
+    if imageCache is not None and tag in imageCache:
+        get_client().images.remove(imageCache[tag].id, force=True)
+        forget_image(imageCache[tag])
+    imgInst = inst.commit()
+    imgInst.tag(tag)
+    imgInst.reload()
+    register_image(imgInst)
+    if imageCache is not None:
+        imageCache[tag] = imgInst
+    print_with_prefix(inst.name, "new image [{}] has been built".format(tag))
+
+def build_container(
+    config: dict = None,
+    ipaddrCache: dict = None,
+    networkCache: dict = None,
+    containerCache: dict = None,
+    sshkeyCache: dict = None,
+    ignoreCmdErr: bool = False,
+    useCache: bool = True,
+    reusedHosts: set = None,
+    commandResults: dict = None,
+    sshKeypairs: dict = None
+):
+    """Build a single docker container instance according to its configuration
+
+    Results of the commands, see command_runner.run_command, are put into commandResults by hostname
+    If sshKeypairs, see ssh_keys.get_ssh_keypairs, is provided, the keypairs and the trust
+    of all the hosts in it are put into the container instead of generating keys in it
+
+    With useCache, the container is fingerprinted, a running container with the same
+    fingerprint is kept as it is, and a container with "copy" entries is created from
+    a previously committed cache image of the same fingerprint, skipping the copy and
+    the commands; set "cache" to false in the configuration to always rebuild it
+    """
+    # Prepare parameters for docker container run command
+    image = config["image"]
+    hostname = config["hostname"]
+
+    # Prepare extra_hosts
+    extraHosts = {}
+    for network in ipaddrCache:
+        if hostname in ipaddrCache[network]["hosts"]:
+            extraHosts.update(ipaddrCache[network]["interfaces"])
+
+    # Ports to expose
+    ports = {}
+    if "ports" in config and type(config["ports"]) == dict:
+        ports = config["ports"]
+
+    # The prebaked ssh keypairs of the container
+    sshKeypair = None
+    if "ssh" in config and config["ssh"] == True and sshKeypairs is not None and hostname in sshKeypairs:
+        sshKeypair = sshKeypairs[hostname]
+
+    # Look for a running container or a cached image of the same fingerprint
+    fingerprint = None
+    fromCache = False
+    if useCache and ("cache" not in config or config["cache"] != False):
+        fingerprint = get_container_fingerprint(config, extraHosts, sshKeypair)
+        if hostname in containerCache:
+            existing = containerCache[hostname]
+            if existing.status == "running" and existing.labels.get(FingerprintLabel) == fingerprint:
+                print_with_prefix(hostname, "container {} is unchanged, keep it".format(hostname))
+                if sshKeypair is not None:
+                    sshkeyCache[hostname] = sshKeypair["user"]["public"]
+                elif "ssh" in config and config["ssh"] == True:
+                    sshkeyCache[hostname] = get_ssh_pub_key(existing)
+                if reusedHosts is not None:
+                    reusedHosts.add(hostname)
+                return existing
+        if "copy" in config:
+            # committed images copy the label from their containers, so only the cache repository is searched
+            cachedImages = get_client().images.list(
+                name = "{}/{}".format(CacheRepository, hostname),
+                filters = {"label": "{}={}".format(FingerprintLabel, fingerprint)}
+            )
+            if len(cachedImages) > 0:
+                image = cachedImages[0].id
+                fromCache = True
+                print_with_prefix(hostname, "found cached image {} for container {}".format(cachedImages[0].tags, hostname))
+
+    # Create an basic instance of the container
+    if hostname in containerCache:
+        containerCache[hostname].remove(force = True)
+        forget_container(hostname)
+    # Envrionment variables
+    environment = {}
+    if "environment" in config:
+        environment = config["environment"]
+    # Volumes
+    volumes = {}
+    if "volumes" in config:
+        for key in config["volumes"]:
+            v = config["volumes"][key]
+            if type(v) == dict and "bind" in v and "mode" in v:
+                volumes[key] = v
+    # Keep the container running in background
+    print_with_prefix(hostname, "building container {} from image {}...".format(hostname, image))
+    inst = get_client().containers.run(
+        image,
+        hostname = hostname,
+        name = hostname,
+        detach = True,
+        tty = True,
+        extra_hosts = extraHosts,
+        ports = ports,
+        environment = environment,
+        volumes = volumes,
+        labels = {FingerprintLabel: fingerprint} if fingerprint is not None else {}
+    )
+    # the returned instance is still "created", reload it so the registry sees it running
+    inst.reload()
+    containerCache[hostname] = register_container(inst)
+
+    # Copy files
+    if "copy" in config and not fromCache:
+        for copy in config["copy"]:
+            if "source" not in copy or "target" not in copy:
+                continue
+            if "source" == "" or "target" == "":
+                continue
+            if not os.path.exists(copy["source"]):
+                continue
+            filterList = None
+            if "filter" in copy:
+                filterList = copy["filter"]
+            ignoreFile = None
+            if "ignoreFile" in copy:
+                ignoreFile = copy["ignoreFile"]
+            if os.path.isdir(copy["source"]):
+                sync_to_container(inst, copy["source"], copy["target"], filterList, ignoreFile = ignoreFile)
+
+    # Connect to desired network
+    if "networkInterfaces" in config:
+        for interface in config["networkInterfaces"]:
+            if "network" not in interface:
+                continue
+            networkName = interface["network"]
+            if networkName not in networkCache:
+                # the network may be created after the caches were prepared
+                network = get_network(networkName)
+                if network is not None:
+                    networkCache[networkName] = network
+            if networkName not in networkCache:
+                continue
+            ipv4_address = None
+            if "ipv4" in interface:
+                ipv4_address = interface["ipv4"]
+            print_with_prefix(hostname, "container [{}] ip adress [{}] is on".format(hostname, ipv4_address))
+            networkCache[networkName].connect(
+                inst.id,
+                ipv4_address = ipv4_address
+            )
+
+    # setup ssh
+    if "ssh" in config and config["ssh"] == True:
+        if sshKeypair is not None:
+            sshkey = install_prebaked_ssh(inst, hostname, sshKeypairs)
+        else:
+            sshkey = setup_ssh(inst)
+        sshkeyCache[hostname] = sshkey
+        print_with_prefix(hostname, "container [{}] ssh has been setup".format(hostname))
+
+    # exec commands
+    if "commands" in config and not fromCache:
+        commands = config["commands"]
+        commandList = None
+        if "cmd" in commands:
+            commandList = commands["cmd"]
+        if commandList is not None \
+            and type(commandList) == list \
+            and len(commandList) > 0:
+            workdir = "/"
+            if "workdir" in commands:
+                workdir = commands["workdir"]
+            environment = {}
+            if "environment" in commands:
+                environment = commands["environment"]
+            timeout = None
+            if "timeout" in commands:
+                timeout = commands["timeout"]
+            results = run_commands(inst, commandList, workdir, environment, timeout, ignoreCmdErr, prefix = hostname)
+            if commandResults is not None:
+                commandResults[hostname] = results
+            for result in results:
+                if ignoreCmdErr:
+                    break
+                if result["timedOut"]:
+                    print_with_prefix(hostname, "building process of container {} failed".format(hostname))
+                    sys.exit(1)
+                if result["exitCode"] != 0:
+                    print_with_prefix(hostname, "building process of container {} failed".format(hostname))
+                    sys.exit(result["exitCode"])
+
+    # cache the provisioned container for the next build
+    if fingerprint is not None and "copy" in config and not fromCache:
+        repository = "{}/{}".format(CacheRepository, hostname)
+        cacheImage = inst.commit(
+            repository = repository,
+            tag = fingerprint[:16],
+            conf = {"Labels": {FingerprintLabel: fingerprint}}
+        )
+        # only the latest cache image of the container is kept
+        for img in get_client().images.list(name = repository):
+            if img.id != cacheImage.id:
+                get_client().images.remove(img.id, force = True)
+                forget_image(img)
+        print_with_prefix(hostname, "container {} has been cached as image {}/{}:{}".format(hostname, CacheRepository, hostname, fingerprint[:16]))
+
+    # normal operations have been done
+    print_with_prefix(hostname, "container {} has been built from image {}\n".format(hostname, image))
+    return inst
+
+def plan_containers(
+    containerConfFile:str = None,
+    configuration: dict = None,
+    baseDir: str = None,
     hosts: [] = None,
-    ignoreCmdErr: bool = False
+    ignoreCmdErr: bool = False,
+    useCache: bool = True,
+    commandResults: dict = None,
+    prebakedSsh: bool = False
 ):
-    """Build docker container instances according to the configuration
+    """Prepare the tasks to build docker container instances according to the configuration
+
+    With prebakedSsh, the ssh keypairs of all containers with ssh are generated on the host
+    once and cached by hostname, so a rebuilt container keeps its keys and the trust of the others
+
+    return a tuple of (tasks, dependencies) for run_tasks, the task names are:
+    "container:<hostname>" to create and provision a container,
+    "ssh-trust" to build ssh trust relationships between the containers,
+    "commit:<hostname>" to commit a container to the image in its configuration
+    results of the commands executed in the containers are put into commandResults by hostname
     """
     configBaseDir = baseDir
     if baseDir is None and containerConfFile is not None:
@@ -30,6 +377,174 @@ def build_containers(
     if configBaseDir is None:
         configBaseDir = './'
 
+    configList = configuration
+    if configuration is None and containerConfFile is not None:
+        with open(containerConfFile) as f:
+            configList = json.load(f)
+    if configList is None or type(configList) != list:
+        raise Exception('container configuration is invalid')
+
+    # Prepare the image list
+    imageCache = get_images()
+
+    # Prepare the network list
+    networkCache = get_networks()
+
+    # Prepare the container list
+    containerCache = get_containers()
+
+    # Prepare the ssh key cache
+    sshkeyCache = {}
+
+    # Prepare the IP Address cache
+    # And generate temporary hostname for the container if hostname is not provided
+    ipaddrCache = {}
+    hostFilter = None
+    if hosts is not None and type(hosts) == list:
+        hostFilter = hosts
+    for config in configList:
+        hostname = None
+        if "hostname" in config:
+            hostname = config["hostname"]
+        else:
+            hostname = "vm{}".format(round(time.time()))
+            config["hostname"] = hostname
+
+        if "networkInterfaces" in config:
+            for interface in config["networkInterfaces"]:
+                if "network" not in interface:
+                    continue
+                network = interface["network"]
+                if network not in ipaddrCache:
+                    ipaddrCache[network] = {}
+                if "hosts" not in ipaddrCache[network]:
+                    ipaddrCache[network]["hosts"] = set()
+                ipaddrCache[network]["hosts"].add(hostname)
+                if "interfaces" not in ipaddrCache[network]:
+                    ipaddrCache[network]["interfaces"] = {}
+
+                interfaceName = hostname
+                if "name" in interface and interface["name"] != "hostname":
+                    interfaceName = interface["name"]
+
+                ipaddrCache[network]["interfaces"][interfaceName] = {}
+                if "ipv4" in interface:
+                    ipaddrCache[network]["interfaces"][interfaceName] = interface["ipv4"]
+                elif "ipv6" in interface:
+                    ipaddrCache[network]["interfaces"][interfaceName] = interface["ipv6"]
+
+    # Containers committed to images which other containers are built from
+    hostDependencies = get_container_dependencies(configList)
+    consumedHosts = set()
+    for hostname in hostDependencies:
+        consumedHosts.update(hostDependencies[hostname])
+
+    # Prepare the prebaked ssh keypairs
+    sshKeypairs = None
+    newKeyHosts = set()
+    if prebakedSsh:
+        sshHosts = [c["hostname"] for c in configList if "image" in c and "ssh" in c and c["ssh"] == True]
+        sshKeypairs = get_ssh_keypairs(sshHosts, newHosts = newKeyHosts)
+
+    tasks = {}
+    dependencies = {}
+    trustDependencies = []
+    reusedHosts = set()
+    for config in configList:
+        if "image" not in config:
+            continue
+        hostname = config["hostname"]
+        if hostFilter is not None and hostname not in hostFilter:
+            continue
+        taskName = "container:{}".format(hostname)
+        tasks[taskName] = (lambda c: lambda: build_container(
+            c, ipaddrCache, networkCache, containerCache, sshkeyCache,
+            ignoreCmdErr = ignoreCmdErr, useCache = useCache, reusedHosts = reusedHosts,
+            commandResults = commandResults, sshKeypairs = sshKeypairs
+        ))(config)
+        dependencies[taskName] = []
+        for dep in hostDependencies[hostname]:
+            if dep in consumedHosts and get_commit_tag(find_config(configList, dep)) is not None:
+                dependencies[taskName].append("commit:{}".format(dep))
+            else:
+                dependencies[taskName].append("container:{}".format(dep))
+        if "ssh" in config and config["ssh"] == True:
+            trustDependencies.append(taskName)
+
+        # Commit to build an image if needed, the image of a container which others
+        # are built from is committed before building ssh trust relationships
+        tag = get_commit_tag(config)
+        if tag is not None:
+            commitName = "commit:{}".format(hostname)
+            def commitTask(hostname = hostname, tag = tag):
+                # an unchanged container is not committed again, so its image id stays the same
+                if hostname in reusedHosts and tag in imageCache:
+                    return
+                commit_container(containerCache[hostname], tag, imageCache)
+            tasks[commitName] = commitTask
+            dependencies[commitName] = [taskName]
+            if hostname not in consumedHosts:
+                dependencies[commitName].append("ssh-trust")
+
+    # build or rebuild ssh trust relationships
+    def trustTask():
+        # containers which are not rebuilt already trust each other, only the rebuilt ones are updated
+        changedHosts = set([name[len("container:"):] for name in trustDependencies]) - reusedHosts
+        if sshKeypairs is not None:
+            # rebuilt containers got the whole trust with the prebaked keys
+            targets = [h for h in sshKeypairs if h not in changedHosts]
+            spread_prebaked_ssh_keys(targets, containerCache, sshKeypairs, newKeyHosts)
+            return
+        build_ssh_trust_relationships(configList, hostFilter, sshkeyCache, containerCache, changedHosts)
+    tasks["ssh-trust"] = trustTask
+    dependencies["ssh-trust"] = trustDependencies
+    return (tasks, dependencies)
+
+def find_config(configList: list = None, hostname: str = None):
+    """Find the configuration of a container by its hostname
+    """
+    if configList is None:
+        return None
+    for config in configList:
+        if "hostname" in config and config["hostname"] == hostname:
+            return config
+    return None
+
+def build_containers(
+    containerConfFile:str = None,
+    configuration: dict = None,
+    baseDir: str = None,
+    hosts: [] = None,
+    ignoreCmdErr: bool = False,
+    maxParallel: int = 1,
+    useCache: bool = True,
+    prebakedSsh: bool = False
+):
+    """Build docker container instances according to the configuration
+
+    Independent containers are built concurrently when maxParallel is greater than 1,
+    a container is built only after the containers it depends on
+
+    return a dictionary of hostname and the results of the commands executed in the container
+    """
+    try:
+        commandResults = {}
+        (tasks, dependencies) = plan_containers(containerConfFile, configuration, baseDir, hosts, ignoreCmdErr, useCache, commandResults, prebakedSsh)
+        run_tasks(tasks, dependencies, maxParallel)
+        print("everything is done")
+        return commandResults
+
+    except Exception as e:
+        print('Error when building containers:', repr(e))
+        raise
+
+def sync_containers(
+    containerConfFile:str = None,
+    configuration: dict = None,
+    hosts: [] = None
+):
+    """Synchronize the copied sources of running containers incrementally, without rebuilding them
+    """
     try:
         configList = configuration
         if configuration is None and containerConfFile is not None:
@@ -38,208 +553,31 @@ def build_containers(
         if configList is None or type(configList) != list:
             raise Exception('container configuration is invalid')
 
-        # Prepare the image list
-        imageCache = {}
-        for img in client.images.list(all=True):
-            for t in img.tags:
-                imageCache[t] = img
-
-        # Prepare the network list
-        networkCache = {}
-        for inst in client.networks.list():
-            networkCache[inst.name] = inst
-
-        # Prepare the container list
-        containerCache = {}
-        for inst in client.containers.list(all = True):
-            containerCache[inst.name] = inst
-
-        # Prepare the ssh key cache
-        sshkeyCache = {}
-
-        # Prepare the IP Address cache
-        # And generate temporary hostname for the container if hostname is not provided
-        ipaddrCache = {}
-        hostFilter = None
-        if hosts is not None and type(hosts) == list:
-            hostFilter = hosts
-        for config in configList:
-            hostname = None
-            if "hostname" in config:
-                hostname = config["hostname"]
-            else:
-                hostname = "vm"+round(time.time())
-                config["hostname"] = hostname
-
-            if "networkInterfaces" in config:
-                for interface in config["networkInterfaces"]:
-                    if "network" not in interface:
-                        continue
-                    network = interface["network"]
-                    if network not in ipaddrCache:
-                        ipaddrCache[network] = {}
-                    if "hosts" not in ipaddrCache[network]:
-                        ipaddrCache[network]["hosts"] = set()
-                    ipaddrCache[network]["hosts"].add(hostname)
-                    if "interfaces" not in ipaddrCache[network]:
-                        ipaddrCache[network]["interfaces"] = {}
-
-                    interfaceName = hostname
-                    if "name" in interface and interface["name"] != "hostname":
-                        interfaceName = interface["name"]
-
-                    ipaddrCache[network]["interfaces"][interfaceName] = {}
-                    if "ipv4" in interface:
-                        ipaddrCache[network]["interfaces"][interfaceName] = interface["ipv4"]
-                    elif "ipv6" in interface:
-                        ipaddrCache[network]["interfaces"][interfaceName] = interface["ipv6"]
-
-        # Build the container one by one
+        containerCache = get_containers(running = True)
+
         for config in configList:
-            if "image" not in config:
+            if "hostname" not in config or "copy" not in config:
                 continue
-            # Prepare parameters for docker container run command
-            image = config["image"]
             hostname = config["hostname"]
-
-            if hostFilter is not None and hostname not in hostFilter:
+            if hosts is not None and hostname not in hosts:
                 continue
-
-            # Prepare extra_hosts
-            extraHosts = {}
-            for network in ipaddrCache:
-                if hostname in ipaddrCache[network]["hosts"]:
-                    extraHosts.update(ipaddrCache[network]["interfaces"])
-
-            # Ports to expose
-            ports = {}
-            if "ports" in config and type(config["ports"]) == dict:
-                ports = config["ports"]
-
-            # Create an basic instance of the container
-            if hostname in containerCache:
-                containerCache[hostname].remove(force = True)
-            # Envrionment variables
-            environment = {}
-            if "environment" in config:
-                environment = config["environment"]
-            # Volumes
-            volumes = {}
-            if "volumes" in config:
-                for key in config["volumes"]:
-                    v = config["volumes"][key]
-                    if type(v) == dict and "bind" in v and "mode" in v:
-                        volumes[key] = v
-            # Keep the container running in background
-            print("building container {} from image {}...".format(hostname, image))
-            inst = client.containers.run(
-                image,
-                hostname = hostname,
-                name = hostname,
-                detach = True,
-                tty = True,
-                extra_hosts = extraHosts,
-                ports = ports,
-                environment = environment,
-                volumes = volumes
-            )
-            containerCache[hostname] = inst
-
-            # Copy files
-            if "copy" in config:
-                for copy in config["copy"]:
-                    if "source" not in copy or "target" not in copy:
-                        continue
-                    if "source" == "" or "target" == "":
-                        continue
-                    if not os.path.exists(copy["source"]):
-                        continue
-                    if "filter" in copy:
-                        filterList = copy["filter"]
-                    if os.path.isdir(copy["source"]):
-                        copy_to_container(inst, copy["source"], copy["target"], filterList)
-
-            # Connect to desired network
-            if "networkInterfaces" in config:
-                for interface in config["networkInterfaces"]:
-                    if "network" not in interface:
-                        continue
-                    networkName = interface["network"]
-                    if networkName not in networkCache:
-                        continue
-                    ipv4_address = None
-                    if "ipv4" in interface:
-                        ipv4_address = interface["ipv4"]
-                    print("container [{}] ip adress [{}] is on".format(hostname, ipv4_address))
-                    networkCache[networkName].connect(
-                        inst.id, 
-                        ipv4_address = ipv4_address
-                    )
-
-            # setup ssh
-            if "ssh" in config and config["ssh"] == True:
-                sshkey = setup_ssh(inst)
-                sshkeyCache[hostname] = sshkey
-                print("container [{}] ssh has been setup".format(hostname))
-
-            # exec commands
-            if "commands" in config:
-                commands = config["commands"]
-                commandList = None
-                if "cmd" in commands:
-                    commandList = commands["cmd"]
-                if commandList is not None \
-                    and type(commandList) == list \
-                    and len(commandList) > 0:
-                    workdir = "/"
-                    if "workdir" in commands:
-                        workdir = commands["workdir"]
-                    environment = {}
-                    if "environment" in commands:
-                        environment = commands["environment"]
-                    for cmd in commandList:
-                        cmdStart = time.time()
-                        print("[{}:{}/{}] command execution started at <{}>...".format(hostname, workdir, cmd, time.ctime()))
-                        (exit_code, output) = inst.exec_run(
-                            cmd,
-                            workdir = workdir,
-                            environment = environment,
-                            stream = ignoreCmdErr
-                        )
-                        if not ignoreCmdErr:
-                            print(output.decode("utf8"))
-                        else:
-                            for line in output:
-                                print(line.decode("utf8"))
-                        cmdEnd = time.time()
-                        print("[{}:{}/{}] command execution finished in {} seconds with exit code: {}\n".format(hostname, workdir, cmd, round(cmdEnd - cmdStart, 1), exit_code))
-                        if not ignoreCmdErr and exit_code > 0:
-                            print("building process of container {} failed".format(hostname))
-                            sys.exit(exit_code)
-
-            # normal operations have been done                            
-            print("container {} has been built from image {}\n".format(hostname, image))
-
-        # build or rebuild ssh trust relationships
-        build_ssh_trust_relationships(configList, hostFilter, sshkeyCache, containerCache)
-
-        print("")
-        # Commit and build images if needed
-        for config in configList:
-            hostname = config["hostname"]
-            if hostFilter is not None and hostname not in hostFilter:
+            if hostname not in containerCache:
+                print("container {} is not running, skip syncing".format(hostname))
                 continue
-            inst = containerCache[hostname]
-            # Commit to build an image if needed
-            if "commit" in config and "image" in config["commit"] and "tag" in config["commit"]:
-                tag = "{}:{}".format(config["commit"]["image"], config["commit"]["tag"])
-                if tag in imageCache:
-                    client.images.remove(imageCache[tag].id, force=True)
-                imgInst = inst.commit()
-                imgInst.tag(tag)
-                print("new image [{}] has been built".format(tag))
-        print("everything is done")
+            for copy in config["copy"]:
+                if "source" not in copy or "target" not in copy:
+                    continue
+                if not os.path.isdir(copy["source"]):
+                    continue
+                filterList = None
+                if "filter" in copy:
+                    filterList = copy["filter"]
+                ignoreFile = None
+                if "ignoreFile" in copy:
+                    ignoreFile = copy["ignoreFile"]
+                sync_to_container(containerCache[hostname], copy["source"], copy["target"], filterList, ignoreFile = ignoreFile)
+        print("everything is synced")
 
     except Exception as e:
-        print('Error when building containers:', repr(e))
+        print('Error when syncing containers:', repr(e))
         raise
@@ -5,40 +5,152 @@ import argparse
 
 argParser = argparse.ArgumentParser(description='create or config database')
 argParser.add_argument('--env', type=str, required=False, help='env tag, such as dev, prod, test, ...')
-argParser.add_argument('--database-settings-file', type=str, required=True, help='project settings file in JSON format')
+argParser.add_argument('--database-settings-file', type=str, required=True, help='project settings file in JSON format, it could contain a list of database settings')
+argParser.add_argument('--sql-file', type=str, action='append', required=False, help='SQL file to execute as the database user after the schema is created, such as a seed file')
+argParser.add_argument('--snapshot', action='store_true', required=False, help='save the current databases as templates named <database>_template')
+argParser.add_argument('--reset', action='store_true', required=False, help='drop the databases and clone them from their templates')
 args = argParser.parse_args()
 
 db_settings_file = args.database_settings_file
 env = args.env
 
-def exec(cmd):
-    print(cmd)
-    os.system(cmd)
+def psql_value(value):
+    """Quote a value for the psql \\set command
+    """
+    text = str(value).replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n')
+    return "'" + text + "'"
+
+def exec(psqlArgs, script, password = None):
+    """Run the script in a single psql session, stop at the first error
+    """
+    cmd = ['psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1'] + psqlArgs
+    print(' '.join(cmd), flush = True)
+    cmdEnv = dict(os.environ)
+    if password is not None:
+        cmdEnv['PGPASSWORD'] = str(password)
+    result = subprocess.run(cmd, input = script.encode('utf8'), env = cmdEnv)
+    if result.returncode != 0:
+        raise Exception('psql exited with code {}'.format(result.returncode))
+
+def superuser_script(settingsList):
+    """Create the databases and users if they do not exist, grant privileges and create extensions
+    """
+    lines = []
+    for settings in settingsList:
+        lines += [
+            '\\set database ' + psql_value(settings["database"]),
+            '\\set user ' + psql_value(settings["user"]),
+            '\\set password ' + psql_value(settings["password"]),
+            '\\connect postgres',
+            "SELECT format('CREATE DATABASE %I', :'database') WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = :'database') \\gexec",
+            "SELECT format('CREATE USER %I WITH PASSWORD %L', :'user', :'password') WHERE NOT EXISTS (SELECT FROM pg_roles WHERE rolname = :'user') \\gexec",
+            'GRANT ALL PRIVILEGES ON DATABASE :"database" TO :"user";',
+            '\\connect :"database"',
+            'CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'
+        ]
+    return '\n'.join(lines) + '\n'
+
+def user_script(settings, sqlFiles):
+    """Create the schema as the database user and run the SQL files in it
+    """
+    lines = [
+        '\\set schema ' + psql_value(settings["schema"]),
+        '\\set user ' + psql_value(settings["user"]),
+        'CREATE SCHEMA IF NOT EXISTS :"schema";',
+        'GRANT USAGE ON SCHEMA :"schema" TO :"user";',
+        'SET search_path TO :"schema", public;',
+        'SELECT uuid_generate_v4();'
+    ]
+    for sqlFile in sqlFiles:
+        lines.append('\\i ' + psql_value(sqlFile))
+    return '\n'.join(lines) + '\n'
+
+def terminate_sessions_script():
+    return "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = :'database' AND pid <> pg_backend_pid();"
+
+def snapshot_script(settingsList):
+    """Replace the template of each database with a copy of its current content
+    """
+    lines = []
+    for settings in settingsList:
+        lines += [
+            '\\set database ' + psql_value(settings["database"]),
+            '\\set template ' + psql_value(settings["database"] + "_template"),
+            "SELECT format('ALTER DATABASE %I IS_TEMPLATE false', :'template') WHERE EXISTS (SELECT FROM pg_database WHERE datname = :'template') \\gexec",
+            'DROP DATABASE IF EXISTS :"template";',
+            terminate_sessions_script(),
+            'CREATE DATABASE :"template" TEMPLATE :"database";',
+            'ALTER DATABASE :"template" IS_TEMPLATE true ALLOW_CONNECTIONS false;'
+        ]
+    return '\n'.join(lines) + '\n'
+
+def reset_script(settingsList):
+    """Drop each database and clone it from its template
+    """
+    lines = []
+    for settings in settingsList:
+        lines += [
+            '\\set database ' + psql_value(settings["database"]),
+            '\\set template ' + psql_value(settings["database"] + "_template"),
+            '\\set user ' + psql_value(settings["user"]),
+            "SELECT NOT EXISTS (SELECT FROM pg_database WHERE datname = :'template') AS missing \\gset",
+            '\\if :missing',
+            "\\echo 'template' :template 'does not exist, please take a snapshot first'",
+            "DO $$ BEGIN RAISE EXCEPTION 'template database does not exist'; END $$;",
+            '\\endif',
+            terminate_sessions_script(),
+            'DROP DATABASE IF EXISTS :"database";',
+            'CREATE DATABASE :"database" TEMPLATE :"template";',
+            'GRANT ALL PRIVILEGES ON DATABASE :"database" TO :"user";'
+        ]
+    return '\n'.join(lines) + '\n'
 
 try:
     with open(db_settings_file) as f:
         database_settings = json.load(f)
+    if type(database_settings) == dict:
+        database_settings = [database_settings]
 
-    TYPE = database_settings["type"]
-    USER = database_settings["settings"]["user"]
-    PASSWORD = database_settings["settings"]["password"]
-    DATABASE = database_settings["settings"]["database"]
-    SCHEMA = database_settings["settings"]["schema"]
-    HOST = database_settings["settings"]["host"]
-    PORT = database_settings["settings"]["port"]
-
-    if TYPE == "postgres":
-        exec('psql -h ' + HOST + ' -p ' + str(PORT) + ' -c "CREATE DATABASE ' + DATABASE + ';"')
-        exec('psql -h ' + HOST + ' -p ' + str(PORT) + ' -d ' + DATABASE + ' -c "CREATE USER ' + USER + ' WITH PASSWORD \'' + PASSWORD + '\';"')
-        exec('psql -h ' + HOST + ' -p ' + str(PORT) + ' -d ' + DATABASE + ' -c "GRANT ALL PRIVILEGES ON DATABASE ' + DATABASE + ' TO ' + USER + ';"')
-        exec('psql -h ' + HOST + ' -p ' + str(PORT) + ' -d ' + DATABASE + ' -c "CREATE EXTENSION IF NOT EXISTS \\\"uuid-ossp\\\";"')
-        exec('PGPASSWORD=' + PASSWORD + ' psql -h ' + HOST + ' -p ' + str(PORT) + ' -U ' + USER + ' -d ' + DATABASE + ' -c "CREATE SCHEMA IF NOT EXISTS ' + SCHEMA +';"')
-        exec('PGPASSWORD=' + PASSWORD + ' psql -h ' + HOST + ' -p ' + str(PORT) + ' -U ' + USER + ' -d ' + DATABASE + ' -c "GRANT USAGE ON SCHEMA ' + SCHEMA + ' TO ' + USER + ';"')
-        exec('PGPASSWORD=' + PASSWORD + ' psql -h ' + HOST + ' -p ' + str(PORT) + ' -U ' + USER + ' -d ' + DATABASE + ' -c "SELECT uuid_generate_v4();"')
+    settingsList = []
+    seedFiles = {}
+    for item in database_settings:
+        if item["type"] != "postgres":
+            print('database type {} is not supported'.format(item["type"]))
+            continue
+        settingsList.append(item["settings"])
+        seedFiles[item["settings"]["database"]] = (args.sql_file or []) + item.get("seed", [])
+    if len(settingsList) == 0:
+        sys.exit(0)
+
+    # one superuser session for each database server
+    servers = {}
+    for settings in settingsList:
+        servers.setdefault((settings["host"], str(settings["port"])), []).append(settings)
+
+    if args.reset:
+        for (HOST, PORT) in servers:
+            exec(['-h', HOST, '-p', PORT, '-d', 'postgres'], reset_script(servers[(HOST, PORT)]))
+        print('databases [{}] have been reset'.format(', '.join([x["database"] for x in settingsList])))
+        sys.exit(0)
+
+    for (HOST, PORT) in servers:
+        exec(['-h', HOST, '-p', PORT, '-d', 'postgres'], superuser_script(servers[(HOST, PORT)]))
+    for settings in settingsList:
+        exec(
+            ['-h', settings["host"], '-p', str(settings["port"]), '-U', settings["user"], '-d', settings["database"]],
+            user_script(settings, seedFiles[settings["database"]]),
+            settings["password"]
+        )
+        print('database {} is ready'.format(settings["database"]))
+
+    if args.snapshot:
+        for (HOST, PORT) in servers:
+            exec(['-h', HOST, '-p', PORT, '-d', 'postgres'], snapshot_script(servers[(HOST, PORT)]))
+        print('templates of databases [{}] have been saved'.format(', '.join([x["database"] for x in settingsList])))
 
 except FileNotFoundError as e:
     print('Database settings file does not exist on the location: ' + db_settings_file)
     raise e
 except Exception as e:
-    print('unknown error', e)
-    raise e
+    print('failed to create database:', e)
+    sys.exit(1)
@@ -1,86 +1,215 @@
 #!/usr/bin/env python3
+import copy
 import json
 import os
 import time
 import tarfile
-import docker
-import sys
 if __name__ == "lib.db_builder":
     from lib.utils import copy_to_container
+    from lib.docker_client import get_container
+    from lib.command_runner import run_command
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.readiness import postgres_probe
+    from lib.readiness import wait_until_ready
+    from lib.tracing import traced
 else:
     from env.lib.utils import copy_to_container
+    from env.lib.docker_client import get_container
+    from env.lib.command_runner import run_command
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.readiness import postgres_probe
+    from env.lib.readiness import wait_until_ready
+    from env.lib.tracing import traced
 
-client = docker.from_env()
-
-def create_postgres_databases(confFilePath:str = None, configuration: dict = None):
+def get_database_hosts(confFilePath:str = None, configuration: dict = None):
+    """Return the list of container hostnames which the databases are created on
+    """
     configList = configuration
-    execDir = os.path.dirname(sys.argv[0])
-    dbScriptFile = "{}/env/lib/create_postgres_database.py".format(execDir)
-    if not os.path.exists(dbScriptFile):
-        raise Exception("Can not locate the script file [{}] for creating databases".format(dbScriptFile))
+    if configList is None:
+        if confFilePath is None or not os.path.exists(confFilePath):
+            return []
+        with open(confFilePath) as f:
+            configList = json.load(f)
+    if type(configList) == dict:
+        configList = [configList]
+    hosts = []
+    for config in configList:
+        if "settings" in config and "host" in config["settings"] and config["settings"]["host"] not in hosts:
+            hosts.append(config["settings"]["host"])
+    return hosts
+
+def load_database_configs(confFilePath = None, configuration = None):
+    """Load the database configurations from a file, a list of files, or an already loaded
+    configuration, return them as a list
+
+    a configuration could have "seed", a list of SQL files relative to its configuration file,
+    which are executed after the database is created
+    """
+    configList = []
+    if configuration is not None:
+        configList += configuration if type(configuration) == list else [configuration]
+    confFiles = confFilePath
+    if confFilePath is None:
+        confFiles = []
+    elif type(confFilePath) == str:
+        confFiles = [confFilePath]
+    for confFile in confFiles:
+        if not os.path.exists(confFile):
+            print('database configuration file {} does not exist'.format(confFile))
+            continue
+        with open(confFile) as f:
+            content = json.load(f)
+        if type(content) == dict:
+            content = [content]
+        elif type(content) != list:
+            raise Exception('Invalid configuration format in {}'.format(confFile))
+        for config in content:
+            if "seed" in config:
+                config["seed"] = [os.path.join(os.path.dirname(os.path.abspath(confFile)), x) for x in config["seed"]]
+        configList += content
+    return configList
 
-    if configuration is None \
-        and ( confFilePath is None or not os.path.exists(confFilePath)):
-        return
+def group_postgres_databases(configList: list = None):
+    """Group the postgres database configurations by the container hostname,
+    the host in each returned configuration is replaced by localhost
+    """
+    groups = {}
+    for config in configList or []:
+        if "type" not in config or "settings" not in config:
+            continue
+        if config["type"] != "postgres":
+            continue
+        if "host" not in config["settings"]:
+            continue
+        tmpConfig = copy.deepcopy(config)
+        tmpConfig["settings"]["host"] = "localhost"
+        groups.setdefault(config["settings"]["host"], []).append(tmpConfig)
+    return groups
 
+@traced("provision_postgres_host", ["inst", "action"])
+def provision_postgres_host(inst = None, configList: list = None, action: str = None):
+    """Create the databases in one container by uploading the script and the configurations once
+    and running the script once
+
+    action: None to create the databases, "snapshot" to create them and save them as templates,
+    "reset" to clone them from the templates
+    """
+    dbScriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_postgres_database.py")
+    if not os.path.exists(dbScriptFile):
+        raise Exception("Can not locate the script file [{}] for creating databases".format(dbScriptFile))
     workDir = "/sardines"
-    tmpConfigFile = "./tmp_db_config.json"
     workUser = "postgres"
     workGroup = "postgres"
-    try:
-        if configList is None:
-            with open(confFilePath) as f:
-                configList = json.load(f)
-        if type(configList) == dict:
-            configList = [configList]
-        elif type(configList) != list:
-            raise Exception('Invalid configuration format') 
+    targetDbScriptFile = "{}/create_postgres_database.py".format(workDir)
+    targetConfigFile = "{}/db_config_{}.json".format(workDir, time.time())
 
-        # prepare the container cache
-        containerCache = {}
-        for inst in client.containers.list():
-            containerCache[inst.name] = inst
-        # process the configuration list
-        targetDbScriptFile = "/sardines/create_postgres_database.py"
-        targetConfigFile = "/sardines/db_config.json"
-        for config in configList:
-            if "type" not in config or "settings" not in config:
-                continue
-            if config["type"] != "postgres":
-                continue
-            settings = config["settings"]
-            if "host" not in settings:
-                continue
-            if settings["host"] not in containerCache:
-                continue
-            inst = containerCache[settings["host"]]
-            tmpConfig = config.copy()
-            tmpConfig["settings"]["host"] = "localhost"
-            with open(tmpConfigFile, "w") as f:
-                json.dump(tmpConfig, f)
-            (exit_code, output) = inst.exec_run(
-                "mkdir -p {}".format(workDir)
-            )
-            if exit_code != 0:
-                print(output)
-                raise Exception('failed to create work directory at {} on container {}'.format(workDir, inst.name))
+    (exit_code, output) = inst.exec_run(
+        "mkdir -p {}".format(workDir)
+    )
+    if exit_code != 0:
+        print(output)
+        raise Exception('failed to create work directory at {} on container {}'.format(workDir, inst.name))
 
-            copy_to_container(inst, dbScriptFile, targetDbScriptFile, mode="770", user = workUser, group = workGroup)
-            copy_to_container(inst, tmpConfigFile, targetConfigFile, user = workUser, group = workGroup)
-            (exit_code, output) = inst.exec_run(
-                "{} --database-settings-file {}".format(targetDbScriptFile, targetConfigFile),
-                user = workUser,
-                stream = False
+    copy_to_container(inst, dbScriptFile, targetDbScriptFile, mode="770", user = workUser, group = workGroup)
+    # upload the seed files, their paths are replaced by the ones in the container
+    configList = copy.deepcopy(configList)
+    for config in configList:
+        if "seed" not in config or action == "reset":
+            continue
+        seedDir = "{}/seed/{}".format(workDir, config["settings"]["database"])
+        # the work directory is owned by root, copy_to_container hands the files over to workUser
+        (exit_code, output) = inst.exec_run("mkdir -p {}".format(seedDir))
+        if exit_code != 0:
+            print(output)
+            raise Exception('failed to create seed directory at {} on container {}'.format(seedDir, inst.name))
+        targetSeedFiles = []
+        for i in range(len(config["seed"])):
+            targetSeedFile = "{}/{}_{}".format(seedDir, i, os.path.basename(config["seed"][i]))
+            copy_to_container(inst, config["seed"][i], targetSeedFile, user = workUser, group = workGroup)
+            targetSeedFiles.append(targetSeedFile)
+        config["seed"] = targetSeedFiles
+    copy_to_container(inst, json.dumps(configList).encode("utf8"), targetConfigFile, user = workUser, group = workGroup)
+    options = ""
+    if action is not None:
+        options = " --{}".format(action)
+    result = run_command(
+        inst,
+        "{} --database-settings-file {}{}".format(targetDbScriptFile, targetConfigFile, options),
+        "/",
+        user = workUser,
+        prefix = inst.name
+    )
+    inst.exec_run("rm -f {}".format(targetConfigFile))
+    done = "reset" if action == "reset" else "created"
+    if result["exitCode"] != 0:
+        raise Exception('failed to {} database on container {}'.format("reset" if action == "reset" else "create", inst.name))
+    print_with_prefix(inst.name, 'databases [{}] have been {} on container {} in {} seconds'.format(
+        ', '.join([c["settings"]["database"] for c in configList]), done, inst.name, round(result["duration"], 1)
+    ))
+
+def plan_postgres_databases(confFilePath = None, configuration = None, action: str = None, readyTimeout: float = 180):
+    """Prepare the tasks to create databases, one task named "database:<hostname>" for each container,
+    see provision_postgres_host for the action
+
+    a task waits until postgres in the container accepts connections, at most readyTimeout seconds,
+    since a container just started could be still initializing its database cluster
+
+    return a tuple of (tasks, dependencies) for run_tasks, a task depends on "container:<hostname>"
+    """
+    groups = group_postgres_databases(load_database_configs(confFilePath, configuration))
+    tasks = {}
+    dependencies = {}
+    for host in groups:
+        def task(host = host):
+            inst = get_container(host)
+            if inst is None or inst.status != "running":
+                print('container {} is not running, skip creating databases on it'.format(host))
+                return
+            ports = []
+            for config in groups[host]:
+                port = config["settings"].get("port", 5432)
+                if port not in ports:
+                    ports.append(port)
+            wait_until_ready(
+                [postgres_probe(host, port) for port in ports],
+                timeout = readyTimeout,
+                name = 'postgres on {}'.format(host)
             )
-            print(output.decode("utf8"))
-            if exit_code != 0:
-                raise Exception('failed to create database on container {}'.format(inst.name))
-            else:
-                print('database has been created on container {}'.format(inst.name))
+            provision_postgres_host(inst, groups[host], action)
+        taskName = "database:{}".format(host)
+        tasks[taskName] = task
+        dependencies[taskName] = ["container:{}".format(host)]
+    return (tasks, dependencies)
+
+def create_postgres_databases(
+    confFilePath = None,
+    configuration = None,
+    maxParallel: int = 4,
+    snapshot: bool = False,
+    readyTimeout: float = 180
+):
+    """Create postgres databases in the containers, databases on different containers are created concurrently
+
+    confFilePath: a configuration file path, or a list of them
+    snapshot: save the created databases as templates, which reset_postgres_databases clones them from
+    readyTimeout: seconds to wait for postgres to accept connections
+    """
+    try:
+        (tasks, _) = plan_postgres_databases(confFilePath, configuration, "snapshot" if snapshot else None, readyTimeout)
+        run_tasks(tasks, None, maxParallel)
     except Exception as e:
         print('Error when creating databases:', e)
         raise e
-    finally:
-        if os.path.exists(tmpConfigFile):
-            os.remove(tmpConfigFile)
 
+def reset_postgres_databases(confFilePath = None, configuration = None, maxParallel: int = 4, readyTimeout: float = 180):
+    """Drop the postgres databases and clone them from the templates saved by create_postgres_databases
+    with snapshot, which is much faster than creating them again
+    """
+    try:
+        (tasks, _) = plan_postgres_databases(confFilePath, configuration, "reset", readyTimeout)
+        run_tasks(tasks, None, maxParallel)
+    except Exception as e:
+        print('Error when resetting databases:', e)
+        raise e
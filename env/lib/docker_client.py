@@ -0,0 +1,198 @@
+# module for sharing one docker client and a registry of containers, networks and images
+import threading
+import docker
+
+MaxPoolSize = 32
+
+clientLock = threading.Lock()
+registryLock = threading.RLock()
+client = None
+registry = None
+
+def get_client():
+    """Return the shared docker client, which is created on first use
+    """
+    global client
+    if client is None:
+        with clientLock:
+            if client is None:
+                client = docker.from_env(max_pool_size = MaxPoolSize)
+    return client
+
+def load_registry():
+    """Fill the registry by listing containers, networks and images once,
+    and start following docker events to keep it up to date
+    """
+    global registry
+    if registry is not None:
+        return registry
+    with registryLock:
+        if registry is not None:
+            return registry
+        c = get_client()
+        containers = {}
+        for inst in c.containers.list(all = True):
+            containers[inst.name] = inst
+        networks = {}
+        for inst in c.networks.list():
+            networks[inst.name] = inst
+        images = {}
+        for img in c.images.list():
+            for t in img.tags:
+                images[t] = img
+        registry = {"containers": containers, "networks": networks, "images": images}
+        thread = threading.Thread(target = follow_events, daemon = True)
+        thread.start()
+    return registry
+
+def follow_events():
+    """Update the registry according to docker events
+    """
+    c = get_client()
+    try:
+        for event in c.events(decode = True, filters = {"type": ["container", "network", "image"]}):
+            try:
+                handle_event(event)
+            except docker.errors.NotFound:
+                pass
+            except Exception as e:
+                print('Error when handling docker event:', e)
+    except Exception as e:
+        print('docker events are not followed any more:', e)
+        reset_registry()
+
+def handle_event(event: dict = None):
+    eventType = event.get("Type")
+    action = event.get("Action", "")
+    actor = event.get("Actor", {})
+    attributes = actor.get("Attributes", {})
+    c = get_client()
+    if eventType == "container":
+        name = attributes.get("name")
+        if name is None or action.startswith("exec_"):
+            return
+        # a late event of a removed container must not evict a new one of the same name
+        if action == "destroy":
+            forget_container(name, actor.get("ID"))
+        else:
+            register_container(c.containers.get(actor["ID"]))
+    elif eventType == "network":
+        name = attributes.get("name")
+        if action == "destroy":
+            forget_network(name, actor.get("ID"))
+        elif action == "create":
+            register_network(c.networks.get(actor["ID"]))
+    elif eventType == "image":
+        if action in ["untag", "delete"]:
+            with registryLock:
+                if registry is not None:
+                    for t in [t for t in registry["images"] if registry["images"][t].id == actor["ID"]]:
+                        del registry["images"][t]
+        if action in ["tag", "untag", "pull", "import", "load"]:
+            register_image(c.images.get(actor["ID"]))
+
+def reset_registry():
+    """Drop the registry, it will be filled again on next use
+    """
+    global registry
+    with registryLock:
+        registry = None
+
+def get_container(name: str = None):
+    """Return the container by name, or None if it does not exist
+    """
+    reg = load_registry()
+    with registryLock:
+        if name in reg["containers"]:
+            return reg["containers"][name]
+    try:
+        return register_container(get_client().containers.get(name))
+    except docker.errors.NotFound:
+        return None
+
+def get_containers(running: bool = False):
+    """Return a dictionary of container name and instance
+    """
+    reg = load_registry()
+    with registryLock:
+        return {name: inst for (name, inst) in reg["containers"].items() if not running or inst.status == "running"}
+
+def register_container(inst):
+    with registryLock:
+        if registry is not None:
+            registry["containers"][inst.name] = inst
+    return inst
+
+def forget_container(name: str = None, instId: str = None):
+    """Remove the container from the registry, only if it is still the one of instId when instId is given
+    """
+    with registryLock:
+        if registry is not None and name in registry["containers"]:
+            if instId is None or registry["containers"][name].id == instId:
+                del registry["containers"][name]
+
+def get_network(name: str = None):
+    """Return the network by name, or None if it does not exist
+    """
+    reg = load_registry()
+    with registryLock:
+        if name in reg["networks"]:
+            return reg["networks"][name]
+    networks = get_client().networks.list(names = [name])
+    for network in networks:
+        if network.name == name:
+            return register_network(network)
+    return None
+
+def get_networks():
+    """Return a dictionary of network name and instance
+    """
+    reg = load_registry()
+    with registryLock:
+        return dict(reg["networks"])
+
+def register_network(network):
+    with registryLock:
+        if registry is not None:
+            registry["networks"][network.name] = network
+    return network
+
+def forget_network(name: str = None, instId: str = None):
+    """Remove the network from the registry, only if it is still the one of instId when instId is given
+    """
+    with registryLock:
+        if registry is not None and name in registry["networks"]:
+            if instId is None or registry["networks"][name].id == instId:
+                del registry["networks"][name]
+
+def get_image(tag: str = None):
+    """Return the image by tag or id, or None if it does not exist
+    """
+    reg = load_registry()
+    with registryLock:
+        if tag in reg["images"]:
+            return reg["images"][tag]
+    try:
+        return register_image(get_client().images.get(tag))
+    except docker.errors.ImageNotFound:
+        return None
+
+def get_images():
+    """Return a dictionary of image tag and instance
+    """
+    reg = load_registry()
+    with registryLock:
+        return dict(reg["images"])
+
+def register_image(img):
+    with registryLock:
+        if registry is not None:
+            for t in img.tags:
+                registry["images"][t] = img
+    return img
+
+def forget_image(img):
+    with registryLock:
+        if registry is not None:
+            for t in [t for t in registry["images"] if registry["images"][t].id == img.id]:
+                del registry["images"][t]
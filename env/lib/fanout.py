@@ -0,0 +1,128 @@
+# module for running an operation on many hosts concurrently
+import json
+import time
+if __name__ == "lib.fanout":
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.command_runner import run_command
+    from lib.docker_client import get_container
+    from lib.utils import prepare_environment
+else:
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.command_runner import run_command
+    from env.lib.docker_client import get_container
+    from env.lib.utils import prepare_environment
+
+def fan_out(hosts: list = None, operation = None, maxParallel: int = 4, failFast: bool = False):
+    """Run the operation on all hosts concurrently
+
+    operation: a callable taking the hostname, it returns an exit code or raises an exception on failure
+    failFast: do not start the operation on more hosts once it failed on one of them
+
+    return a dictionary of hostname and a dictionary of host, status, exitCode, begin, end, duration and error,
+    status is one of 'ok', 'failed' and 'skipped'
+    """
+    results = {}
+    for host in hosts or []:
+        results[host] = {
+            "host": host,
+            "status": "skipped",
+            "exitCode": None,
+            "begin": None,
+            "end": None,
+            "duration": None,
+            "error": None
+        }
+
+    def task(host):
+        result = results[host]
+        result["begin"] = time.time()
+        try:
+            exitCode = operation(host)
+            result["exitCode"] = 0 if exitCode is None else exitCode
+        except Exception as e:
+            result["error"] = str(e)
+        result["end"] = time.time()
+        result["duration"] = result["end"] - result["begin"]
+        if result["error"] is None and result["exitCode"] == 0:
+            result["status"] = "ok"
+        else:
+            result["status"] = "failed"
+            if failFast:
+                raise Exception('operation failed on host {}'.format(host))
+        return result
+
+    tasks = {}
+    for host in results:
+        tasks[host] = (lambda h: lambda: task(h))(host)
+    try:
+        run_tasks(tasks, None, maxParallel)
+    except Exception as e:
+        print_with_prefix(None, '{}, the remaining hosts are skipped'.format(e))
+    return results
+
+def exec_on_hosts(
+    hosts: list = None,
+    cmd: str = None,
+    workdir: str = "/sardines/shoal",
+    environment: list = None,
+    maxParallel: int = 4,
+    failFast: bool = False,
+    timeout: float = None
+):
+    """Execute a command on all hosts concurrently, the output is printed with hostname prefixes
+
+    return the results of fan_out
+    """
+    def operation(host):
+        inst = get_container(host)
+        if not inst:
+            raise Exception('Can not find container instance [{}]'.format(host))
+        env = prepare_environment(inst, environment)
+        result = run_command(inst, cmd, workdir, env, timeout, prefix = host)
+        if result["timedOut"]:
+            raise Exception('timeout after {} seconds'.format(timeout))
+        return result["exitCode"]
+    return fan_out(hosts, operation, maxParallel, failFast)
+
+def print_fanout_summary(results: dict = None, title: str = None):
+    """Print a table of status, exit code and duration of each host
+    """
+    if results is None or len(results) == 0:
+        return
+    print("")
+    if title is not None:
+        print(title)
+    print("    {:<32} {:<8} {:>9} {:>9}  {}".format("host", "status", "exit code", "seconds", "error"))
+    for host in results:
+        r = results[host]
+        print("    {:<32} {:<8} {:>9} {:>9}  {}".format(
+            host,
+            r["status"],
+            "-" if r["exitCode"] is None else r["exitCode"],
+            "-" if r["duration"] is None else round(r["duration"], 1),
+            "" if r["error"] is None else r["error"]
+        ))
+    count = {}
+    for r in results.values():
+        count[r["status"]] = count.get(r["status"], 0) + 1
+    print("    " + ", ".join(["{}: {}".format(k, count[k]) for k in sorted(count.keys())]))
+
+def write_fanout_report(results: dict = None, reportFile: str = None, extra: dict = None):
+    """Write the results of fan_out to a JSON file
+    """
+    if reportFile is None:
+        return
+    report = {}
+    if extra is not None:
+        report.update(extra)
+    report["hosts"] = list((results or {}).values())
+    with open(reportFile, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('report has been written to', reportFile)
+
+def fanout_failed(results: dict = None):
+    """Return True if the operation did not succeed on all hosts
+    """
+    return any([r["status"] != "ok" for r in (results or {}).values()])
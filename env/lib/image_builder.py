@@ -1,20 +1,104 @@
 # module for building images
+import hashlib
 import json
 import os
+import re
 import time
 import tarfile
-import docker
 import sys
+if __name__ == "lib.image_builder":
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.tracing import traced
+    from lib.docker_client import get_client
+    from lib.docker_client import get_image
+    from lib.docker_client import register_image
+else:
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.tracing import traced
+    from env.lib.docker_client import get_client
+    from env.lib.docker_client import get_image
+    from env.lib.docker_client import register_image
 
-client = docker.from_env()
+DigestLabel = "sardines.dockerfile.digest"
 
-def build_images(imgConfFile:str = None, configuration: dict = None, baseDir: str = None):
+def get_dockerfile_digest(dockerfile: str = None, context: str = None):
+    """Return the sha256 digest of the dockerfile content, and the build context path if any
+    """
+    h = hashlib.sha256()
+    with open(dockerfile, 'rb') as f:
+        h.update(f.read())
+    if context is not None:
+        h.update(os.path.abspath(context).encode('utf8'))
+    return h.hexdigest()
+
+def get_base_images(dockerfile: str = None):
+    """Return the image names in the FROM instructions of the dockerfile
+    """
+    result = []
+    with open(dockerfile) as f:
+        for line in f:
+            m = re.match(r'^\s*FROM\s+(?:--platform=\S+\s+)?(\S+)', line, re.IGNORECASE)
+            if m:
+                result.append(m.group(1))
+    return result
+
+@traced("build_image", ["tag"])
+def build_image(tag: str = None, dockerfile: str = None, context: str = None, force: bool = False):
+    """Build a single image, skip it if an image of the tag was built from the same dockerfile
+
+    the build log is printed as it comes, the existing image of the tag is used as cache
+    """
+    digest = get_dockerfile_digest(dockerfile, context)
+    existing = get_image(tag)
+    if existing is not None and not force and existing.labels.get(DigestLabel) == digest:
+        return
+    if existing is not None and existing.labels.get(DigestLabel) != digest:
+        print_with_prefix(tag, 'dockerfile of image [{}] has been changed, rebuilding'.format(tag))
+
+    beginTime = time.time()
+    kwargs = {
+        "tag": tag,
+        "labels": {DigestLabel: digest},
+        "rm": True,
+        "decode": True
+    }
+    if existing is not None:
+        kwargs["cache_from"] = [tag]
+    df = None
+    if context is not None:
+        kwargs["path"] = context
+        kwargs["dockerfile"] = os.path.relpath(dockerfile, context)
+    else:
+        df = open(dockerfile, 'rb')
+        kwargs["fileobj"] = df
+    try:
+        for chunk in get_client().api.build(**kwargs):
+            if "stream" in chunk:
+                text = chunk["stream"].rstrip('\n')
+                if text != '':
+                    print_with_prefix(tag, text)
+            elif "status" in chunk:
+                print_with_prefix(tag, chunk["status"], chunk.get("progress", ""))
+            elif "error" in chunk:
+                raise Exception('failed to build image {}: {}'.format(tag, chunk["error"]))
+    finally:
+        if df is not None:
+            df.close()
+    register_image(get_client().images.get(tag))
+    print_with_prefix(tag, 'docker image [{}] has been built in {} seconds'.format(tag, round(time.time() - beginTime, 1)))
+
+def build_images(imgConfFile:str = None, configuration: dict = None, baseDir: str = None, maxParallel: int = 1, force: bool = False):
     """Build docker images
 
     argument list:
     imgConfFile: image configuration file path
     configuration: an already loaded dictionary object of the configuration file content
     baseDir: used to resolve the file path within the configuration dictionary
+    maxParallel: maximum number of images to build at the same time,
+                 an image is built after the configured images in its FROM instructions
+    force: rebuild the images even if their dockerfiles are unchanged
     """
     try:
         imgConf = configuration
@@ -25,18 +109,18 @@ def build_images(imgConfFile:str = None, configuration: dict = None, baseDir: st
             with open(imgConfFile) as f:
                 imgConf = json.load(f)
                 confBaseDir = os.path.dirname(imgConfFile)
-        # get local images 
-        localImages = client.images.list()
-        localImageTags = []
-        for img in localImages:
-            localImageTags.extend(img.tags)
-        # build images
+        # prepare build tasks
+        tasks = {}
+        dependencies = {}
         for imgName in imgConf.keys():
             for imgTag in imgConf[imgName].keys():
                 conf = imgConf[imgName][imgTag]
                 dockerfile = None
+                context = None
                 if type(conf) == dict and conf["dockerfile"] is not None:
                     dockerfile = conf["dockerfile"]
+                    if "context" in conf and conf["context"] is not None:
+                        context = os.path.relpath(os.path.join(confBaseDir, conf["context"]))
                 elif type(conf) == str:
                     dockerfile = conf
                 if dockerfile is None:
@@ -45,13 +129,9 @@ def build_images(imgConfFile:str = None, configuration: dict = None, baseDir: st
                 dockerfile = os.path.relpath(os.path.join(confBaseDir, dockerfile))
                 if not os.path.exists(dockerfile):
                     raise Exception('dockerfile does not exist at {} for building image {}:{}'.format(dockerfile, imgName, imgTag))
-                # check whether the image already exists
                 tag = '{}:{}'.format(imgName, imgTag)
-                if tag not in localImageTags:
-                    with open(dockerfile, 'rb') as df:
-                        (imgInst, logs) = client.images.build(fileobj = df, tag = tag)
-                    for log in logs:
-                        print(log)
-                    print('docker image [{}] has been built'.format(tag))
+                tasks[tag] = (lambda t, d, c: lambda: build_image(t, d, c, force))(tag, dockerfile, context)
+                dependencies[tag] = get_base_images(dockerfile)
+        run_tasks(tasks, dependencies, maxParallel)
     except Exception as e:
-        print('Error when building image:', e)
\ No newline at end of file
+        print('Error when building image:', e)
@@ -5,8 +5,14 @@ import time
 import tarfile
 import docker
 import sys
-
-client = docker.from_env()
+if __name__ == "lib.network_builder":
+    from lib.docker_client import get_client
+    from lib.docker_client import get_networks
+    from lib.docker_client import register_network
+else:
+    from env.lib.docker_client import get_client
+    from env.lib.docker_client import get_networks
+    from env.lib.docker_client import register_network
 
 def create_networks(netConfFile:str = None, configuration:dict = None):
     """To create custom networks according to configuration
@@ -24,7 +30,7 @@ def create_networks(netConfFile:str = None, configuration:dict = None):
         if netConf is None:
             raise Exception('can not read configuration data')
         # list local networks
-        netlist = [x.name for x in client.networks.list()]
+        netlist = get_networks()
         # process the network configuration
         for networkName in netConf.keys():
             if networkName in netlist:
@@ -40,11 +46,11 @@ def create_networks(netConfFile:str = None, configuration:dict = None):
             driver = "bridge"
             if "driver" in conf.keys():
                 driver = conf["driver"]
-            client.networks.create(
+            register_network(get_client().networks.create(
                 networkName,
                 driver = driver,
                 ipam = ipam_config
-            )
+            ))
             print('network [{}] is created'.format(networkName))
 
     except Exception as e:
@@ -0,0 +1,121 @@
+# module for filtering source files with gitignore style patterns
+import os
+import re
+
+def translate_pattern(pattern: str = None):
+    """Translate a gitignore style glob pattern to a regular expression,
+    which matches a path relative to the source directory
+    """
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                regex += '\\['
+            else:
+                group = pattern[i + 1:j]
+                if group.startswith('!'):
+                    group = '^' + group[1:]
+                regex += '[' + group.replace('\\', '\\\\') + ']'
+                i = j
+        else:
+            regex += re.escape(c)
+        i += 1
+    if anchored:
+        return '^' + regex + '$'
+    # a pattern without slash matches a name at any level
+    return '^(?:.*/)?' + regex + '$'
+
+def compile_filter(patterns: list = None):
+    """Compile gitignore style patterns to a function, which takes a relative path
+    and whether it is a directory, and returns True if the path is excluded
+
+    supported syntax: '*', '?', '[...]', '**', '!' for negation, trailing '/' for directories only,
+    a pattern containing '/' is relative to the source directory, otherwise it matches at any level;
+    the last matching pattern wins
+    """
+    rules = []
+    if patterns is not None:
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if pattern == '' or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            dirOnly = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if pattern == '':
+                continue
+            rules.append((re.compile(translate_pattern(pattern)), negate, dirOnly))
+
+    def excluded(relPath: str = None, isDir: bool = False):
+        if len(rules) == 0:
+            return False
+        relPath = relPath.replace(os.sep, '/')
+        result = False
+        for (regex, negate, dirOnly) in rules:
+            if dirOnly and not isDir:
+                continue
+            if regex.match(relPath):
+                result = not negate
+        return result
+    return excluded
+
+def load_ignore_file(filepath: str = None):
+    """Read patterns from an ignore file, such as .dockerignore or .gitignore
+    """
+    if filepath is None or not os.path.isfile(filepath):
+        return []
+    with open(filepath) as f:
+        return [line.rstrip('\n') for line in f]
+
+def get_source_filter(src: str = None, filterList: list = None, ignoreFile: str = None):
+    """Compile the filter list and the patterns of the ignore file in the source directory
+    """
+    patterns = []
+    if ignoreFile is not None and src is not None:
+        patterns.extend(load_ignore_file(os.path.join(src, ignoreFile)))
+    if filterList is not None:
+        patterns.extend(filterList)
+    return compile_filter(patterns)
+
+def walk_source(src: str = None, excluded = None):
+    """Generate (relative path, is directory) of the entries in the source directory,
+    excluded directories are pruned without descending into them
+    """
+    stack = ['']
+    while len(stack) > 0:
+        relRoot = stack.pop()
+        subdirs = []
+        with os.scandir(os.path.join(src, relRoot)) as it:
+            entries = sorted(it, key = lambda x: x.name)
+        for entry in entries:
+            rel = entry.name if relRoot == '' else relRoot + '/' + entry.name
+            isDir = entry.is_dir(follow_symlinks = False)
+            if excluded is not None and excluded(rel, isDir):
+                continue
+            yield (rel, isDir)
+            if isDir:
+                subdirs.append(rel)
+        stack.extend(reversed(subdirs))
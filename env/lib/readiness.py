@@ -0,0 +1,163 @@
+# module for waiting until services in containers are ready
+import json
+import os
+import socket
+import time
+import urllib.request
+import urllib.error
+if __name__ == "lib.readiness":
+    from lib.docker_client import get_container
+else:
+    from env.lib.docker_client import get_container
+
+def get_container_address(hostname: str = None, network: str = None):
+    """Return the IP address of the container on the network, or on its first network
+    """
+    inst = get_container(hostname)
+    if inst is None:
+        raise Exception('container {} does not exist'.format(hostname))
+    inst.reload()
+    networks = inst.attrs["NetworkSettings"]["Networks"]
+    if network is not None and network in networks and networks[network]["IPAddress"]:
+        return networks[network]["IPAddress"]
+    for name in networks:
+        if networks[name]["IPAddress"]:
+            return networks[name]["IPAddress"]
+    raise Exception('container {} does not have any IP address'.format(hostname))
+
+def process_probe(hostname: str = None, pattern: str = None):
+    """Create a probe which checks whether a process matching the pattern is running in the container
+    """
+    def probe():
+        inst = get_container(hostname)
+        if inst is None:
+            return False
+        (exit_code, output) = inst.exec_run("pgrep -f '{}'".format(pattern), stream = False)
+        return exit_code == 0
+    probe.__name__ = "process [{}] on {}".format(pattern, hostname)
+    return probe
+
+def postgres_probe(hostname: str = None, port: int = 5432):
+    """Create a probe which checks whether postgres in the container accepts connections on the TCP port,
+    by pg_isready, which fails while postgres is starting up or running its init scripts
+    """
+    def probe():
+        inst = get_container(hostname)
+        if inst is None:
+            return False
+        (exit_code, output) = inst.exec_run("pg_isready -q -h localhost -p {}".format(port), stream = False)
+        return exit_code == 0
+    probe.__name__ = "postgres {}:{}".format(hostname, port)
+    return probe
+
+def tcp_probe(host: str = None, port: int = None, timeout: float = 2):
+    """Create a probe which checks whether the TCP port accepts connections,
+    the host could be an address or a container name
+    """
+    def probe():
+        address = host
+        try:
+            socket.getaddrinfo(host, port)
+        except socket.gaierror:
+            address = get_container_address(host)
+        try:
+            with socket.create_connection((address, port), timeout = timeout):
+                return True
+        except OSError:
+            return False
+    probe.__name__ = "tcp {}:{}".format(host, port)
+    return probe
+
+def http_probe(host: str = None, port: int = None, path: str = "/", protocol: str = "http", timeout: float = 2):
+    """Create a probe which checks whether the HTTP endpoint responds,
+    any HTTP status means the server is up, the host could be an address or a container name
+    """
+    def probe():
+        address = host
+        try:
+            socket.getaddrinfo(host, port)
+        except socket.gaierror:
+            address = get_container_address(host)
+        url = "{}://{}:{}{}".format(protocol, address, port, path)
+        try:
+            with urllib.request.urlopen(url, timeout = timeout):
+                return True
+        except urllib.error.HTTPError:
+            return True
+        except (urllib.error.URLError, OSError):
+            return False
+    probe.__name__ = "{} {}:{}{}".format(protocol, host, port, path)
+    return probe
+
+def repository_probes(repoDeployPlanFile: str = None, repoHost: str = None):
+    """Create HTTP probes for the providers of a repository according to its deploy plan
+    """
+    probes = []
+    if repoDeployPlanFile is None or not os.path.exists(repoDeployPlanFile):
+        return probes
+    with open(repoDeployPlanFile) as f:
+        deployPlan = json.load(f)
+    if repoHost is None and "host" in deployPlan and "name" in deployPlan["host"]:
+        repoHost = deployPlan["host"]["name"]
+    if "providers" not in deployPlan:
+        return probes
+    for provider in deployPlan["providers"]:
+        if "providerSettings" not in provider:
+            continue
+        settings = provider["providerSettings"]
+        if "port" not in settings:
+            continue
+        protocol = "http"
+        if "protocol" in settings and settings["protocol"] in ["http", "https"]:
+            protocol = settings["protocol"]
+        root = "/"
+        if "root" in settings:
+            root = settings["root"]
+        probes.append(http_probe(repoHost, settings["port"], root, protocol))
+    return probes
+
+def wait_until_ready(
+    probes: list = None,
+    timeout: float = 180,
+    initialDelay: float = 1,
+    maxDelay: float = 15,
+    name: str = None
+):
+    """Poll the probes with exponential backoff until all of them pass, or raise when the deadline is reached
+
+    arguments:
+    probes: a list of callables without arguments, which return True when ready
+    timeout: seconds to wait before giving up
+    initialDelay: seconds to wait after the first failed polling, doubled after each failure
+    maxDelay: maximum seconds between two pollings
+    name: name of the target to be printed
+    """
+    if probes is None or len(probes) == 0:
+        return
+    beginTime = time.time()
+    deadline = beginTime + timeout
+    delay = initialDelay
+    pending = list(probes)
+    while True:
+        failed = []
+        for probe in pending:
+            try:
+                ready = probe()
+            except Exception as e:
+                print('probe [{}] error:'.format(probe.__name__), e)
+                ready = False
+            if not ready:
+                failed.append(probe)
+        pending = failed
+        if len(pending) == 0:
+            print('{} is ready in {} seconds'.format(name, round(time.time() - beginTime, 1)))
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            errMsg = '{} is not ready in {} seconds, failed probes: {}'.format(
+                name, timeout, ', '.join([probe.__name__ for probe in pending])
+            )
+            print(errMsg)
+            raise Exception(errMsg)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, maxDelay)
@@ -0,0 +1,39 @@
+#! /usr/bin/env python3
+
+import subprocess, sys, json
+import argparse
+
+argParser = argparse.ArgumentParser(description='remove service runtimes according to a removal plan, '
+    + 'the repository manager is started once for each item of the plan with its modules, versions, '
+    + 'services, tags and hosts as comma separated lists, all the hosts of an item are handled by that one process')
+argParser.add_argument('--removal-plan-file', type=str, required=True, help='removal plan file in JSON format')
+argParser.add_argument('--manager', type=str, required=False, default='./lib/manager/manageRepository.js', help='repository manager script')
+argParser.add_argument('repo_deploy_plan', type=str, help='deploy plan file of the repository')
+args = argParser.parse_args()
+
+def exec(cmd):
+    print(' '.join(cmd), flush = True)
+    return subprocess.call(cmd)
+
+try:
+    with open(args.removal_plan_file) as f:
+        removalPlan = json.load(f)
+
+    failed = 0
+    for item in removalPlan:
+        cmd = [args.manager, '--remove-service-runtimes']
+        applications = item.get("applications", [])
+        cmd.append('--applications={}'.format(','.join(applications) if len(applications) > 0 else '*'))
+        for key in ["modules", "versions", "services", "tags", "hosts"]:
+            if key in item and len(item[key]) > 0:
+                cmd.append('--{}={}'.format(key, ','.join(item[key])))
+        cmd.append(args.repo_deploy_plan)
+        exitCode = exec(cmd)
+        if exitCode != 0:
+            print('failed to remove service runtimes, exit code: {}'.format(exitCode))
+            failed = exitCode
+    sys.exit(failed)
+
+except FileNotFoundError as e:
+    print('Removal plan file does not exist on the location: ' + args.removal_plan_file)
+    raise e
@@ -0,0 +1,147 @@
+# module for running tasks concurrently according to their dependencies
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+if __name__ == "lib.scheduler":
+    from lib.tracing import span
+else:
+    from env.lib.tracing import span
+
+printLock = threading.Lock()
+
+def print_with_prefix(prefix: str = None, *args):
+    """Print a message line by line with a prefix, such as a hostname,
+    lines of different threads will not be mixed up
+    """
+    text = ' '.join([str(x) for x in args])
+    with printLock:
+        if prefix is None:
+            print(text, flush = True)
+            return
+        for line in text.split('\n'):
+            print('[{}] {}'.format(prefix, line), flush = True)
+
+def check_dependencies(tasks: dict = None, dependencies: dict = None):
+    """Validate the dependency graph and return it as a dict of sets,
+    dependencies on names which are not in the task list are dropped
+    """
+    if tasks is None:
+        return {}
+    graph = {}
+    for name in tasks:
+        graph[name] = set()
+        if dependencies is not None and name in dependencies:
+            for dep in dependencies[name]:
+                if dep in tasks and dep != name:
+                    graph[name].add(dep)
+
+    # detect cycles by removing the tasks without dependencies repeatedly
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    while len(remaining) > 0:
+        ready = [name for name in remaining if len(remaining[name]) == 0]
+        if len(ready) == 0:
+            raise Exception('circular dependencies among tasks: {}'.format(', '.join(sorted(remaining.keys()))))
+        for name in ready:
+            del remaining[name]
+        for name in remaining:
+            remaining[name].difference_update(ready)
+    return graph
+
+def timed_task(name: str = None, task = None, timings: dict = None):
+    """Wrap the task to record its begin and end time in timings, and a span of it
+    """
+    def wrapper():
+        beginTime = time.time()
+        try:
+            with span(str(name)):
+                return task()
+        finally:
+            if timings is not None:
+                timings[name] = (beginTime, time.time())
+    return wrapper
+
+def run_tasks(tasks: dict = None, dependencies: dict = None, maxParallel: int = 1, timings: dict = None):
+    """Run tasks in a thread pool, a task starts as soon as all of its dependencies are done
+
+    arguments:
+    tasks: a dictionary of task name and a callable without arguments
+    dependencies: a dictionary of task name and a list of task names it depends on
+    maxParallel: maximum number of tasks running at the same time
+    timings: if provided, filled with task name and a tuple of (begin, end) time of each finished task
+
+    return a dictionary of task name and the return value of the callable,
+    once a task failed, no more tasks will be started, and the error is raised
+    after the running tasks are finished
+    """
+    if tasks is None or len(tasks) == 0:
+        return {}
+    graph = check_dependencies(tasks, dependencies)
+    if maxParallel is None or maxParallel < 1:
+        maxParallel = 1
+
+    results = {}
+    done = set()
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers = maxParallel) as executor:
+        while True:
+            if error is None:
+                for name in tasks:
+                    if name in done or name in running.values():
+                        continue
+                    if not graph[name].issubset(done):
+                        continue
+                    if len(running) >= maxParallel:
+                        break
+                    running[executor.submit(timed_task(name, tasks[name], timings))] = name
+            if len(running) == 0:
+                break
+            (finished, _) = wait(running.keys(), return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    done.add(name)
+                except BaseException as e:
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return results
+
+def get_critical_path(timings: dict = None, dependencies: dict = None):
+    """Return the chain of tasks which determines the total wall time,
+    starting from the first task and ending at the task finished last
+    """
+    if timings is None or len(timings) == 0:
+        return []
+    path = []
+    name = max(timings.keys(), key = lambda x: timings[x][1])
+    while name is not None:
+        path.insert(0, name)
+        previous = None
+        if dependencies is not None and name in dependencies:
+            for dep in dependencies[name]:
+                if dep not in timings:
+                    continue
+                if previous is None or timings[dep][1] > timings[previous][1]:
+                    previous = dep
+        name = previous
+    return path
+
+def print_task_report(timings: dict = None, dependencies: dict = None):
+    """Print wall time of each task and the critical path
+    """
+    if timings is None or len(timings) == 0:
+        return
+    beginTime = min([x[0] for x in timings.values()])
+    print("")
+    print("task timings (seconds since start, wall time):")
+    for name in sorted(timings.keys(), key = lambda x: timings[x][0]):
+        (taskBegin, taskEnd) = timings[name]
+        print("    {:<48} {:>8} {:>8}".format(name, round(taskBegin - beginTime, 1), round(taskEnd - taskBegin, 1)))
+    path = get_critical_path(timings, dependencies)
+    print("critical path:")
+    for name in path:
+        (taskBegin, taskEnd) = timings[name]
+        print("    {:<48} {:>8}".format(name, round(taskEnd - taskBegin, 1)))
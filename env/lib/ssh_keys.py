@@ -0,0 +1,111 @@
+# module for generating ssh keypairs of the containers ahead of time on the host
+import os
+import subprocess
+if __name__ == "lib.ssh_keys":
+    from lib.scheduler import run_tasks
+    from lib.scheduler import print_with_prefix
+    from lib.utils import tar_contents
+    from lib.utils import update_ssh_trust
+else:
+    from env.lib.scheduler import run_tasks
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.utils import tar_contents
+    from env.lib.utils import update_ssh_trust
+
+SshKeyCacheDir = os.path.join(os.path.expanduser("~"), ".sardines", "ssh-keys")
+KeyType = "ed25519"
+
+def generate_keypair(path: str = None, comment: str = None):
+    """Generate a keypair without passphrase by ssh-keygen on the host
+    """
+    for f in [path, path + '.pub']:
+        if os.path.exists(f):
+            os.remove(f)
+    result = subprocess.run(
+        ["ssh-keygen", "-q", "-t", KeyType, "-N", "", "-C", comment, "-f", path],
+        stdout = subprocess.PIPE,
+        stderr = subprocess.STDOUT
+    )
+    if result.returncode != 0:
+        print(result.stdout.decode("utf8"))
+        raise Exception('failed to generate ssh keypair {}'.format(path))
+
+def read_keypair(path: str = None):
+    with open(path) as f:
+        private = f.read()
+    with open(path + '.pub') as f:
+        public = f.read()
+    return {"private": private, "public": public}
+
+def get_ssh_keypairs(hostnames: list = None, cacheDir: str = None, maxParallel: int = 8, newHosts: set = None):
+    """Return the user and host keypairs of the hosts, the keypairs are generated
+    at the first time and cached in cacheDir/<hostname>
+
+    return a dictionary of hostname and {"user": keypair, "host": keypair},
+    a keypair is {"private": content, "public": content};
+    the hosts whose keypairs are generated this time are added to newHosts
+    """
+    if cacheDir is None:
+        cacheDir = SshKeyCacheDir
+    def load(hostname):
+        hostDir = os.path.join(cacheDir, hostname)
+        userKey = os.path.join(hostDir, "id_{}".format(KeyType))
+        hostKey = os.path.join(hostDir, "ssh_host_{}_key".format(KeyType))
+        if not os.path.exists(userKey + '.pub') or not os.path.exists(hostKey + '.pub'):
+            os.makedirs(hostDir, mode = 0o700, exist_ok = True)
+            generate_keypair(userKey, "root@{}".format(hostname))
+            generate_keypair(hostKey, "root@{}".format(hostname))
+            print_with_prefix(hostname, "ssh keypairs have been generated in {}".format(hostDir))
+            if newHosts is not None:
+                newHosts.add(hostname)
+        return {"user": read_keypair(userKey), "host": read_keypair(hostKey)}
+    tasks = {}
+    for hostname in hostnames or []:
+        tasks[hostname] = (lambda h: lambda: load(h))(hostname)
+    return run_tasks(tasks, None, maxParallel)
+
+def get_known_hosts_line(hostname: str = None, keypairs: dict = None):
+    fields = keypairs[hostname]["host"]["public"].split()
+    return "{} {} {}\n".format(hostname, fields[0], fields[1])
+
+def get_prebaked_ssh_files(hostname: str = None, keypairs: dict = None):
+    """Return the files to put into the container, relative to '/', which trust all
+    the other hosts in keypairs
+    """
+    authorizedKeys = ''.join([keypairs[h]["user"]["public"] for h in keypairs if h != hostname])
+    knownHosts = ''.join([get_known_hosts_line(h, keypairs) for h in keypairs])
+    return {
+        "root/.ssh": (None, 0o700),
+        "root/.ssh/id_{}".format(KeyType): (keypairs[hostname]["user"]["private"], 0o600),
+        "root/.ssh/id_{}.pub".format(KeyType): (keypairs[hostname]["user"]["public"], 0o644),
+        "root/.ssh/authorized_keys": (authorizedKeys, 0o600),
+        "root/.ssh/known_hosts": (knownHosts, 0o644),
+        "etc/ssh/ssh_host_{}_key".format(KeyType): (keypairs[hostname]["host"]["private"], 0o600),
+        "etc/ssh/ssh_host_{}_key.pub".format(KeyType): (keypairs[hostname]["host"]["public"], 0o644)
+    }
+
+def install_prebaked_ssh(container, hostname: str = None, keypairs: dict = None):
+    """Put the prebaked keypairs, authorized_keys and known_hosts into the container
+    and start ssh service, return the public key of the container
+    """
+    container.put_archive('/', tar_contents(get_prebaked_ssh_files(hostname, keypairs)))
+    (exit_code, output) = container.exec_run("service ssh start", stream = False)
+    if exit_code != 0:
+        print(output.decode("utf8"))
+        raise Exception('failed to start ssh service on the container [{}]'.format(container.name))
+    return keypairs[hostname]["user"]["public"]
+
+def spread_prebaked_ssh_keys(hosts: list = None, containerCache: dict = None, keypairs: dict = None, newHosts: set = None, maxParallel: int = 16):
+    """Add the keys of the new hosts to the running containers which were not rebuilt,
+    the rebuilt containers already got everything when their keys were installed
+    """
+    if newHosts is None or len(newHosts) == 0:
+        return
+    sshkeys = {h: keypairs[h]["user"]["public"] for h in newHosts}
+    hostkeys = {h: get_known_hosts_line(h, keypairs) for h in newHosts}
+    tasks = {}
+    for host in hosts or []:
+        if host in newHosts or host not in containerCache:
+            continue
+        tasks[host] = (lambda inst: lambda: update_ssh_trust(inst, sshkeys, hostkeys))(containerCache[host])
+    run_tasks(tasks, None, maxParallel)
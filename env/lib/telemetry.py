@@ -0,0 +1,234 @@
+# module for sampling resource usage of the containers from the docker stats stream
+import array
+import bisect
+import json
+import threading
+import time
+if __name__ == "lib.telemetry":
+    from lib.docker_client import get_client
+    from lib.docker_client import get_containers
+    from lib.scheduler import print_with_prefix
+    from lib.benchmark import get_phase
+else:
+    from env.lib.docker_client import get_client
+    from env.lib.docker_client import get_containers
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.benchmark import get_phase
+
+# columns of the time series of each container, network and block IO are cumulative bytes
+Columns = ["time", "cpuPercent", "memoryUsage", "memoryLimit", "networkRx", "networkTx", "blockRead", "blockWrite"]
+
+def new_series():
+    return {column: array.array('d') for column in Columns}
+
+def parse_stats(stats: dict = None):
+    """Convert a sample of docker stats to a tuple in the order of Columns, except the time
+    """
+    cpu = stats.get("cpu_stats", {})
+    precpu = stats.get("precpu_stats", {})
+    cpuDelta = cpu.get("cpu_usage", {}).get("total_usage", 0) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+    systemDelta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    cpus = cpu.get("online_cpus") or len(cpu.get("cpu_usage", {}).get("percpu_usage") or []) or 1
+    cpuPercent = 0.0
+    if cpuDelta > 0 and systemDelta > 0:
+        cpuPercent = cpuDelta / systemDelta * cpus * 100
+    memory = stats.get("memory_stats", {})
+    # page cache is not counted as used memory, the same as docker stats
+    memoryStats = memory.get("stats", {})
+    cache = memoryStats.get("inactive_file", memoryStats.get("total_inactive_file", 0))
+    memoryUsage = max(0, memory.get("usage", 0) - cache)
+    rx = 0
+    tx = 0
+    for network in (stats.get("networks") or {}).values():
+        rx += network.get("rx_bytes", 0)
+        tx += network.get("tx_bytes", 0)
+    blockRead = 0
+    blockWrite = 0
+    for item in (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        op = item.get("op", "").lower()
+        if op == "read":
+            blockRead += item.get("value", 0)
+        elif op == "write":
+            blockWrite += item.get("value", 0)
+    return (cpuPercent, memoryUsage, memory.get("limit", 0), rx, tx, blockRead, blockWrite)
+
+def sample_container(collector: dict = None, inst = None):
+    """Follow the stats stream of the container until the collector is stopped or the container stops,
+    a sample is kept every interval seconds
+    """
+    name = inst.name
+    lastTime = 0
+    try:
+        for stats in get_client().api.stats(inst.id, decode = True, stream = True):
+            if collector["stop"].is_set():
+                break
+            now = time.time()
+            if now - lastTime < collector["interval"]:
+                continue
+            if "cpu_stats" not in stats or stats.get("read", "").startswith("0001"):
+                continue
+            lastTime = now
+            values = parse_stats(stats)
+            with collector["lock"]:
+                series = collector["series"].setdefault(name, new_series())
+                series["time"].append(now)
+                for i in range(len(values)):
+                    series[Columns[i + 1]].append(values[i])
+    except Exception as e:
+        if not collector["stop"].is_set():
+            print_with_prefix(name, 'stopped sampling resource usage:', e)
+    finally:
+        with collector["lock"]:
+            collector["sampling"].discard(inst.id)
+
+def watch_containers(collector: dict = None):
+    """Start sampling the running containers of the hosts, including the ones created later
+    """
+    while not collector["stop"].is_set():
+        try:
+            for (name, inst) in get_containers(running = True).items():
+                if collector["hosts"] is not None and name not in collector["hosts"]:
+                    continue
+                with collector["lock"]:
+                    if inst.id in collector["sampling"]:
+                        continue
+                    collector["sampling"].add(inst.id)
+                thread = threading.Thread(target = sample_container, args = (collector, inst), daemon = True)
+                thread.start()
+        except Exception as e:
+            print('Error when looking for containers to sample:', e)
+        collector["stop"].wait(collector["watchInterval"])
+
+def start_telemetry(hosts: list = None, interval: float = 1, watchInterval: float = 2):
+    """Start sampling the resource usage of the containers in the background
+
+    hosts: hostnames of the containers to sample, all running containers if None
+    interval: minimum seconds between two samples of a container
+
+    return the collector to pass to the other functions of this module
+    """
+    collector = {
+        "hosts": None if hosts is None else set(hosts),
+        "interval": interval,
+        "watchInterval": watchInterval,
+        "series": {},
+        "phases": [],
+        "sampling": set(),
+        "lock": threading.Lock(),
+        "stop": threading.Event()
+    }
+    thread = threading.Thread(target = watch_containers, args = (collector,), daemon = True)
+    thread.start()
+    return collector
+
+def stop_telemetry(collector: dict = None):
+    collector["stop"].set()
+
+def add_phases(collector: dict = None, timings: dict = None, prefix: str = None):
+    """Add the time windows of the phases from the timings of tasks, see benchmark.get_phase
+    """
+    windows = {}
+    for name in timings or {}:
+        phase = get_phase(name)
+        if prefix is not None:
+            phase = '{}{}'.format(prefix, phase)
+        (taskBegin, taskEnd) = timings[name]
+        if phase not in windows:
+            windows[phase] = [taskBegin, taskEnd]
+        else:
+            windows[phase] = [min(windows[phase][0], taskBegin), max(windows[phase][1], taskEnd)]
+    for phase in windows:
+        collector["phases"].append((phase, windows[phase][0], windows[phase][1]))
+
+def summarize_series(series: dict = None, begin: float = None, end: float = None):
+    """Summarize the samples of a container within the time window,
+    return None if there is no sample in it
+    """
+    first = 0 if begin is None else bisect.bisect_left(series["time"], begin)
+    last = len(series["time"]) - 1 if end is None else bisect.bisect_right(series["time"], end) - 1
+    if last < first:
+        return None
+    indexes = range(first, last + 1)
+    cpu = [series["cpuPercent"][i] for i in indexes]
+    memory = [series["memoryUsage"][i] for i in indexes]
+    return {
+        "samples": len(indexes),
+        "cpuPeak": max(cpu),
+        "cpuAverage": sum(cpu) / len(cpu),
+        "memoryPeak": max(memory),
+        "memoryAverage": sum(memory) / len(memory),
+        "memoryLimit": series["memoryLimit"][last],
+        "networkRx": series["networkRx"][last] - series["networkRx"][first],
+        "networkTx": series["networkTx"][last] - series["networkTx"][first],
+        "blockRead": series["blockRead"][last] - series["blockRead"][first],
+        "blockWrite": series["blockWrite"][last] - series["blockWrite"][first]
+    }
+
+def summarize_telemetry(collector: dict = None):
+    """return a dictionary of "containers" with the summary of each container for the whole run,
+    and "phases" with the summary of each container in each phase
+    """
+    with collector["lock"]:
+        series = {name: {column: array.array('d', collector["series"][name][column]) for column in Columns} for name in collector["series"]}
+    result = {"containers": {}, "phases": {}}
+    for name in sorted(series.keys()):
+        summary = summarize_series(series[name])
+        if summary is not None:
+            result["containers"][name] = summary
+    for (phase, begin, end) in collector["phases"]:
+        phaseSummary = {}
+        for name in sorted(series.keys()):
+            summary = summarize_series(series[name], begin, end)
+            if summary is not None:
+                phaseSummary[name] = summary
+        result["phases"][phase] = phaseSummary
+    return result
+
+def save_telemetry(collector: dict = None, telemetryFile: str = None):
+    """Write the time series in columns, the summary and the phases to a json file
+    """
+    if telemetryFile is None:
+        return
+    with collector["lock"]:
+        columns = {name: {column: collector["series"][name][column].tolist() for column in Columns} for name in collector["series"]}
+    with open(telemetryFile, 'w') as f:
+        json.dump({
+            "columns": Columns,
+            "series": columns,
+            "phases": [{"phase": p, "begin": b, "end": e} for (p, b, e) in collector["phases"]],
+            "summary": summarize_telemetry(collector)
+        }, f)
+    print('telemetry has been written to', telemetryFile)
+
+def print_telemetry_report(collector: dict = None):
+    """Print peak and average cpu and memory of each container, for the whole run and each phase
+    """
+    summary = summarize_telemetry(collector)
+    def printSummary(title, containers):
+        print(title)
+        print("    {:<32} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10}".format("container", "cpu% max", "cpu% avg", "mem max", "mem avg", "net rx+tx", "blk r+w"))
+        for name in containers:
+            s = containers[name]
+            print("    {:<32} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10}".format(
+                name,
+                round(s["cpuPeak"], 1),
+                round(s["cpuAverage"], 1),
+                format_bytes(s["memoryPeak"]),
+                format_bytes(s["memoryAverage"]),
+                format_bytes(s["networkRx"] + s["networkTx"]),
+                format_bytes(s["blockRead"] + s["blockWrite"])
+            ))
+    if len(summary["containers"]) == 0:
+        return
+    print("")
+    printSummary("resource usage of the containers:", summary["containers"])
+    for phase in summary["phases"]:
+        if len(summary["phases"][phase]) > 0:
+            printSummary("resource usage in phase {}:".format(phase), summary["phases"][phase])
+
+def format_bytes(value: float = None):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(value) < 1024:
+            return "{}{}".format(round(value, 1), unit)
+        value /= 1024
+    return "{}TB".format(round(value, 1))
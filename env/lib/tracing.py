@@ -0,0 +1,233 @@
+# module for tracing the orchestration in spans, which are written as a Chrome trace file
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+enabled = False
+spans = []
+spansLock = threading.Lock()
+threadNames = {}
+local = threading.local()
+# time origin of the trace, timestamps are in microseconds since it
+originTime = time.time()
+originCounter = time.perf_counter()
+
+def now():
+    return (time.perf_counter() - originCounter) * 1000000
+
+def enable_tracing(instrumentDocker: bool = True):
+    """Start recording spans, the docker client is instrumented as well if instrumentDocker
+    """
+    global enabled
+    enabled = True
+    if instrumentDocker:
+        instrument_docker()
+
+def describe(value = None):
+    """Return a short JSON friendly description of an attribute value
+    """
+    if value is None or type(value) in (bool, int, float):
+        return value
+    if hasattr(value, 'name') and type(getattr(value, 'name')) == str:
+        return value.name
+    if type(value) == bytes:
+        return "<{} bytes>".format(len(value))
+    text = str(value)
+    if len(text) > 200:
+        text = text[:200] + '...'
+    return text
+
+class Span:
+    """A span on the current thread, use it as a context manager
+    """
+    def __init__(self, name: str = None, attributes: dict = None):
+        self.name = name
+        self.attributes = attributes or {}
+
+    def set(self, key: str = None, value = None):
+        self.attributes[key] = describe(value)
+
+    def __enter__(self):
+        if not enabled:
+            return self
+        self.begin = now()
+        if not hasattr(local, "stack"):
+            local.stack = []
+        local.stack.append(self)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if not enabled or not hasattr(self, "begin"):
+            return False
+        end = now()
+        local.stack.pop()
+        if excType is not None:
+            self.attributes["error"] = describe(excValue)
+        thread = threading.current_thread()
+        event = {
+            "name": self.name,
+            "cat": self.name.replace(':', '.').split('.')[0],
+            "ph": "X",
+            "ts": self.begin,
+            "dur": end - self.begin,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": self.attributes
+        }
+        with spansLock:
+            spans.append(event)
+            threadNames[thread.ident] = thread.name
+        return False
+
+def span(name: str = None, **attributes):
+    """Return a span of the name with the attributes, the attributes could be updated by set
+    """
+    return Span(name, {key: describe(attributes[key]) for key in attributes})
+
+def current_span():
+    """Return the innermost span of the current thread, or a span which is not recorded
+    """
+    if enabled and hasattr(local, "stack") and len(local.stack) > 0:
+        return local.stack[-1]
+    return Span()
+
+def traced(name: str = None, attributes: list = None):
+    """Decorate a function to record a span for each call,
+    the arguments in attributes are recorded as attributes of the span
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        spanName = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            attrs = {}
+            if attributes is not None:
+                try:
+                    bound = signature.bind_partial(*args, **kwargs).arguments
+                    for key in attributes:
+                        if key in bound:
+                            attrs[key] = describe(bound[key])
+                except TypeError:
+                    pass
+            with Span(spanName, attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced_stream(stream = None, name: str = None, attributes: dict = None):
+    """Wrap a stream, such as the output of a streamed exec or a build log, in a span
+    lasting until the stream is exhausted, the size of the chunks is recorded as bytes
+    """
+    s = Span(name, dict(attributes or {}))
+    size = 0
+    with s:
+        for chunk in stream:
+            if type(chunk) in (bytes, str):
+                size += len(chunk)
+            yield chunk
+        s.set("bytes", size)
+
+def count_stream(stream = None, s: Span = None):
+    """Count the bytes of a stream uploaded in the span
+    """
+    size = 0
+    for chunk in stream:
+        size += len(chunk)
+        yield chunk
+    s.set("bytes", size)
+
+instrumented = False
+
+def instrument_docker():
+    """Record spans for the calls to docker, by wrapping the methods of docker-py
+    """
+    global instrumented
+    if instrumented:
+        return
+    instrumented = True
+    import docker.api
+    import docker.models.containers
+    import docker.models.networks
+    import docker.models.images
+
+    def patch(cls, methodName: str = None, spanName: str = None, getAttributes = None, streamed = None):
+        original = getattr(cls, methodName)
+        @functools.wraps(original)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return original(self, *args, **kwargs)
+            attrs = {}
+            if getAttributes is not None:
+                try:
+                    attrs = getAttributes(self, *args, **kwargs)
+                except Exception:
+                    pass
+            with span(spanName, **attrs) as s:
+                if methodName == "put_archive":
+                    data = args[1] if len(args) > 1 else kwargs.get("data")
+                    if type(data) == bytes:
+                        s.set("bytes", len(data))
+                    elif data is not None:
+                        args = (args[0], count_stream(data, s)) + tuple(args[2:])
+                        kwargs.pop("data", None)
+                result = original(self, *args, **kwargs)
+            if streamed is not None and streamed(*args, **kwargs):
+                return traced_stream(result, spanName + ".stream", attrs)
+            return result
+        setattr(cls, methodName, wrapper)
+
+    Container = docker.models.containers.Container
+    patch(docker.models.containers.ContainerCollection, "run", "docker.containers.run",
+        lambda self, image, *a, **k: {"image": image, "host": k.get("name")})
+    patch(Container, "exec_run", "docker.exec_run",
+        lambda self, cmd, *a, **k: {"host": self.name, "cmd": cmd})
+    patch(Container, "put_archive", "docker.put_archive",
+        lambda self, path, *a, **k: {"host": self.name, "path": path})
+    patch(Container, "get_archive", "docker.get_archive",
+        lambda self, path, *a, **k: {"host": self.name, "path": path})
+    patch(Container, "commit", "docker.commit",
+        lambda self, repository = None, tag = None, *a, **k: {"host": self.name, "image": "{}:{}".format(repository, tag)})
+    patch(Container, "remove", "docker.remove",
+        lambda self, *a, **k: {"host": self.name})
+    patch(Container, "reload", "docker.reload",
+        lambda self, *a, **k: {"host": self.name})
+    patch(docker.models.networks.Network, "connect", "docker.networks.connect",
+        lambda self, container, *a, **k: {"network": self.name, "container": container, "ipv4": k.get("ipv4_address")})
+    patch(docker.models.networks.NetworkCollection, "create", "docker.networks.create",
+        lambda self, name, *a, **k: {"network": name})
+    patch(docker.models.images.ImageCollection, "list", "docker.images.list",
+        lambda self, *a, **k: {"filters": k.get("filters")})
+    patch(docker.api.APIClient, "build", "docker.api.build",
+        lambda self, *a, **k: {"tag": k.get("tag")},
+        lambda *a, **k: True)
+    patch(docker.api.APIClient, "exec_create", "docker.api.exec_create",
+        lambda self, container, cmd, *a, **k: {"container": container[:12], "cmd": cmd})
+    patch(docker.api.APIClient, "exec_start", "docker.api.exec_start",
+        lambda self, execId, *a, **k: {"exec": execId[:12]},
+        lambda *a, **k: k.get("stream") == True)
+    patch(docker.api.APIClient, "exec_inspect", "docker.api.exec_inspect",
+        lambda self, execId, *a, **k: {"exec": execId[:12]})
+
+def write_trace(traceFile: str = None):
+    """Write the recorded spans to a file in Chrome trace event format,
+    which could be opened by chrome://tracing or Perfetto
+    """
+    if traceFile is None:
+        return
+    with spansLock:
+        events = list(spans)
+        names = dict(threadNames)
+    for ident in names:
+        events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": names[ident]}})
+    with open(traceFile, 'w') as f:
+        json.dump({
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"startTime": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(originTime))}
+        }, f)
+    print('trace of {} spans has been written to {}'.format(len(spans), traceFile))
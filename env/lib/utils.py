@@ -1,46 +1,142 @@
 #!/usr/bin/env python3
+import hashlib
+import io
+import json
 import os
+import shlex
+import stat
 import tarfile
+import threading
 import time
 import docker
 
-client = docker.from_env()
+if __name__ == "lib.utils":
+    from lib.path_filter import get_source_filter
+    from lib.path_filter import walk_source
+    from lib.docker_client import get_container
+    from lib.docker_client import get_containers
+    from lib.scheduler import run_tasks
+    from lib.tracing import traced
+else:
+    from env.lib.path_filter import get_source_filter
+    from env.lib.path_filter import walk_source
+    from env.lib.docker_client import get_container
+    from env.lib.docker_client import get_containers
+    from env.lib.scheduler import run_tasks
+    from env.lib.tracing import traced
 
-def copy_to_container(container, src:str = None, dst:str = None, filterList = None, user: str = "root", group: str = "root", mode:str = None):
+def tar_stream(src:str = None, arcname: str = None, chunkSize: int = 65536, members = None):
+    """Generate chunks of a tar archive of the source file or directory,
+    the archive is written by a thread into a pipe, so neither a temporary file
+    nor the whole archive in memory is needed
+
+    members: if provided, the source directory itself and only these paths relative to it are archived,
+    it could be a generator
+    """
+    (readFd, writeFd) = os.pipe()
+    errors = []
+    def writer():
+        try:
+            with os.fdopen(writeFd, 'wb') as w:
+                with tarfile.open(fileobj = w, mode = 'w|') as tar:
+                    if members is None:
+                        tar.add(src, arcname = arcname)
+                    else:
+                        tar.add(src, arcname = arcname, recursive = False)
+                        for member in members:
+                            tar.add(os.path.join(src, member), arcname = os.path.join(arcname, member), recursive = False)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target = writer, daemon = True)
+    thread.start()
+    with os.fdopen(readFd, 'rb') as r:
+        while True:
+            chunk = r.read(chunkSize)
+            if not chunk:
+                break
+            yield chunk
+    thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+def tar_content(content = None, arcname: str = None):
+    """Create a tar archive in memory containing a single file,
+    the content could be a string, bytes or a file object
+    """
+    if hasattr(content, 'read'):
+        content = content.read()
+    if type(content) == str:
+        content = content.encode('utf8')
+    info = tarfile.TarInfo(name = arcname)
+    info.size = len(content)
+    info.mtime = time.time()
+    info.mode = 0o644
+    data = io.BytesIO()
+    with tarfile.open(fileobj = data, mode = 'w') as tar:
+        tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+def tar_contents(contents: dict = None, mode: int = 0o644):
+    """Create a tar archive in memory of several files owned by root,
+    contents is a dictionary of file name and its content as a string or bytes,
+    or a tuple of the content and the file mode, a content of None is a directory
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj = data, mode = 'w') as tar:
+        for name in contents:
+            content = contents[name]
+            fileMode = mode
+            if type(content) == tuple:
+                (content, fileMode) = content
+            if type(content) == str:
+                content = content.encode('utf8')
+            info = tarfile.TarInfo(name = name)
+            info.mtime = time.time()
+            info.mode = fileMode
+            info.uid = 0
+            info.gid = 0
+            info.uname = "root"
+            info.gname = "root"
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+                continue
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+@traced("copy_to_container", ["container", "dst"])
+def copy_to_container(container, src = None, dst:str = None, filterList = None, user: str = "root", group: str = "root", mode:str = None, ignoreFile: str = None):
     """Copy source file in a directory to the container
 
     parameter:
+        src: a file or directory path, or the content of a single file
+             as bytes or a file object, which is copied without touching the disk
+        filterList: gitignore style patterns of the paths to exclude when copying a directory
+        ignoreFile: name of an ignore file in the source directory, such as .dockerignore, to read more patterns from
         mode: a string such as "700", "422", "777", "600", "400", which is used to 'chmod' command
     """
-    print('trying to copy {} to {}:{}'.format(src, container.name, dst))
     if container is None or src is None or dst is None:
         return
-    if not os.path.exists(src):
-        raise Exception('source [{}] does not exist'.format(src))
+    isPath = type(src) == str
+    if isPath:
+        print('trying to copy {} to {}:{}'.format(src, container.name, dst))
+        if not os.path.exists(src):
+            raise Exception('source [{}] does not exist'.format(src))
+    else:
+        print('trying to copy content to {}:{}'.format(container.name, dst))
 
-    tarfilename = "{}_tmp_{}.tar".format(src, time.time())
     try:
-        tar = tarfile.open(tarfilename, mode='w')
-        try:
-            if os.path.isdir(src):
-                def filterFunc(item: tarfile.TarInfo):
-                    if filterList is None:
-                        return item
-                    else:
-                        for filterItem in filterList:
-                            if filterItem in item.path:
-                                return None
-                    return item
-
-                tar.add(src, arcname = os.path.basename(dst), filter = filterFunc)
-            else:
-                tar.add(src, arcname = os.path.basename(dst))
-        finally:
-            tar.close()
+        if not isPath:
+            data = tar_content(src, os.path.basename(dst))
+        elif os.path.isdir(src):
+            excluded = get_source_filter(src, filterList, ignoreFile)
+            members = (rel for (rel, isDir) in walk_source(src, excluded))
+            data = tar_stream(src, os.path.basename(dst), members = members)
+        else:
+            data = tar_stream(src, os.path.basename(dst))
 
-        data = open(tarfilename, 'rb').read()
         container.put_archive(os.path.dirname(dst), data)
-        os.remove(tarfilename)
 
         container.exec_run(
             'chown -R {}:{} {}'.format(user, group, dst)
@@ -49,23 +145,140 @@ def copy_to_container(container, src:str = None, dst:str = None, filterList = No
             container.exec_run(
                 'chmod -R {} {}'.format(mode, dst)
             )
-        print('copy done from {} to {}:{}'.format(src, container.name, dst))
+        print('copy done to {}:{}'.format(container.name, dst))
     except Exception as e:
         print('Error when copying source dir to the container', e)
         raise
-    finally:
-        if os.path.exists(tarfilename):
-            os.remove(tarfilename)
 
 
+SyncManifestFile = ".sardines-sync-manifest.json"
+
+def hash_file(filepath: str = None):
+    """Return the sha1 hex digest of the file content
+    """
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(1048576)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_container_file(container, filepath: str = None):
+    """Return the content of a file in the container as bytes, or None if it does not exist
+    """
+    try:
+        (stream, stat) = container.get_archive(filepath)
+    except docker.errors.NotFound:
+        return None
+    data = io.BytesIO()
+    for chunk in stream:
+        data.write(chunk)
+    data.seek(0)
+    with tarfile.open(fileobj = data, mode = 'r') as tar:
+        for item in tar:
+            if item.isfile():
+                return tar.extractfile(item).read()
+    return None
+
+def build_sync_manifest(src: str = None, excluded = None, previous: dict = None, hashFiles: bool = True):
+    """Walk the source directory and return its manifest,
+    the file hash of the previous manifest is reused if size and mtime are unchanged,
+    if hashFiles is False, only size and mtime are recorded
+    """
+    manifest = {"dirs": [], "files": {}}
+    previousFiles = {}
+    if previous is not None and "files" in previous:
+        previousFiles = previous["files"]
+    for (rel, isDir) in walk_source(src, excluded):
+        if isDir:
+            manifest["dirs"].append(rel)
+            continue
+        filepath = os.path.join(src, rel)
+        st = os.lstat(filepath)
+        if stat.S_ISLNK(st.st_mode):
+            digest = "link:" + os.readlink(filepath)
+        elif rel in previousFiles and previousFiles[rel][0] == st.st_size and previousFiles[rel][1] == st.st_mtime:
+            digest = previousFiles[rel][2]
+        elif not hashFiles:
+            digest = None
+        else:
+            digest = hash_file(filepath)
+        manifest["files"][rel] = [st.st_size, st.st_mtime, digest]
+    return manifest
+
+def exec_on_paths(container, cmd: list = None, paths: list = None, batchSize: int = 200):
+    """Execute a command on a list of paths in the container, in batches to keep the command line short
+    """
+    for i in range(0, len(paths), batchSize):
+        (exit_code, output) = container.exec_run(cmd + paths[i:i + batchSize])
+        if exit_code != 0:
+            print(output.decode("utf8"))
+            raise Exception('failed to execute [{}] on container [{}]'.format(' '.join(cmd), container.name))
+
+@traced("sync_to_container", ["container", "dst"])
+def sync_to_container(container, src: str = None, dst: str = None, filterList = None, user: str = "root", group: str = "root", mode: str = None, ignoreFile: str = None):
+    """Synchronize a source directory to the container incrementally
+
+    A manifest of file sizes, mtimes and hashes is kept in the target directory,
+    only added or changed files are copied and removed files are deleted,
+    it falls back to a full copy if the manifest does not exist
+    """
+    if container is None or src is None or dst is None:
+        return
+    if not os.path.isdir(src):
+        copy_to_container(container, src, dst, filterList, user, group, mode)
+        return
+    beginTime = time.time()
+    arcname = os.path.basename(dst)
+    excluded = get_source_filter(src, filterList, ignoreFile)
+    manifestPath = "{}/{}".format(dst, SyncManifestFile)
+    previous = None
+    content = read_container_file(container, manifestPath)
+    if content is not None:
+        try:
+            previous = json.loads(content.decode('utf8'))
+        except ValueError:
+            previous = None
+
+    if previous is None:
+        # files are hashed only when they are found changed in size or mtime later
+        manifest = build_sync_manifest(src, excluded, hashFiles = False)
+        print('no sync manifest at {}:{}, copying the whole directory'.format(container.name, dst))
+        copy_to_container(container, src, dst, filterList, user, group, mode, ignoreFile)
+    else:
+        manifest = build_sync_manifest(src, excluded, previous)
+        changed = [rel for rel in manifest["files"] \
+            if rel not in previous["files"] or previous["files"][rel][2] != manifest["files"][rel][2]]
+        removedFiles = [rel for rel in previous["files"] if rel not in manifest["files"]]
+        previousDirs = set(previous["dirs"])
+        currentDirs = set(manifest["dirs"])
+        removedDirs = [rel for rel in previousDirs if rel not in currentDirs]
+        print('syncing {} to {}:{}, {} changed, {} removed'.format(
+            src, container.name, dst, len(changed), len(removedFiles) + len(removedDirs)
+        ))
+        exec_on_paths(container, ["rm", "-rf"], ["{}/{}".format(dst, rel) for rel in removedFiles + removedDirs])
+        if len(changed) > 0:
+            container.put_archive(os.path.dirname(dst), tar_stream(src, arcname, members = changed))
+            addedDirs = [rel for rel in manifest["dirs"] if rel not in previousDirs]
+            changedPaths = ["{}/{}".format(dst, rel) for rel in addedDirs + changed]
+            exec_on_paths(container, ["chown", "{}:{}".format(user, group)], changedPaths)
+            if mode is not None:
+                exec_on_paths(container, ["chmod", mode], changedPaths)
+    container.put_archive(dst, tar_content(json.dumps(manifest).encode('utf8'), SyncManifestFile))
+    print('sync done from {} to {}:{} in {} seconds'.format(src, container.name, dst, round(time.time() - beginTime, 1)))
+
+@traced("setup_ssh", ["container"])
 def setup_ssh(container):
     """Setup ssh for the container instance, and return the public key
     """
     if container is None:
         return ""
 
+    # the key may already exist if the container is created from a committed image
     (exit_code, output) = container.exec_run(
-        "ssh-keygen -t rsa -N '' -f /root/.ssh/id_rsa",
+        "sh -c \"rm -f /root/.ssh/id_rsa /root/.ssh/id_rsa.pub && ssh-keygen -t rsa -N '' -f /root/.ssh/id_rsa\"",
         stream=False
     )
     if exit_code == 0:
@@ -108,7 +321,73 @@ def get_ssh_pub_key(container):
         print(output.decode("utf8"))
         raise Exception('failed to get ssh public key on container [{}]'.format(container.name))
 
-def build_ssh_trust_relationships(configList:list = None,  hosts:list = None, sshkeyCacheInMem: dict = None, containerCacheInMem: dict = None):
+def scan_host_keys(hosts: list = None, containerCache: dict = None, maxParallel: int = 16):
+    """Scan the ssh host keys of the containers concurrently
+
+    return a dictionary of hostname and its lines for known_hosts
+    """
+    def scan(host):
+        (exit_code, output) = containerCache[host].exec_run(
+            "ssh-keyscan -H {}".format(host),
+            stream = False
+        )
+        if exit_code != 0:
+            errMsg = 'failed to scan host key for container {}'.format(host)
+            print(errMsg)
+            raise Exception(errMsg)
+        return output.decode("utf8")
+    tasks = {}
+    for host in hosts:
+        tasks[host] = (lambda h: lambda: scan(h))(host)
+    return run_tasks(tasks, None, maxParallel)
+
+def push_ssh_trust(container, authorizedKeys: str = None, knownHosts: str = None):
+    """Replace authorized_keys and known_hosts of root in the container with one upload
+    """
+    container.put_archive('/root/.ssh', tar_contents({
+        "authorized_keys": (authorizedKeys, 0o600),
+        "known_hosts": (knownHosts, 0o644)
+    }))
+
+def update_ssh_trust(container, sshkeys: dict = None, hostkeys: dict = None):
+    """Replace the entries of the given hosts in authorized_keys and known_hosts of root
+    in the container with one command, other entries are kept
+
+    sshkeys: a dictionary of hostname and its public key, whose comment is root@<hostname>
+    hostkeys: a dictionary of hostname and its lines for known_hosts
+    """
+    lines = ['cd /root/.ssh', 'touch authorized_keys known_hosts']
+    for host in sshkeys:
+        if host == container.name:
+            continue
+        lines.append('ssh-keygen -R {} -f known_hosts >/dev/null 2>&1'.format(shlex.quote(host)))
+        lines.append("awk -v c={} '$NF != c' authorized_keys > authorized_keys.tmp && mv authorized_keys.tmp authorized_keys".format(
+            shlex.quote('root@{}'.format(host))
+        ))
+        lines.append('printf "%s\\n" {} >> authorized_keys'.format(shlex.quote(sshkeys[host].strip())))
+        lines.append('printf "%s" {} >> known_hosts'.format(shlex.quote(hostkeys[host])))
+    lines.append('chmod 600 authorized_keys && rm -f known_hosts.old')
+    (exit_code, output) = container.exec_run(["sh", "-c", " && ".join(lines)], stream = False)
+    if exit_code != 0:
+        print(output.decode("utf8"))
+        raise Exception('failed to update ssh trust relationships on container {}'.format(container.name))
+
+@traced("build_ssh_trust_relationships", ["changedHosts"])
+def build_ssh_trust_relationships(
+    configList:list = None,
+    hosts:list = None,
+    sshkeyCacheInMem: dict = None,
+    containerCacheInMem: dict = None,
+    changedHosts: set = None,
+    maxParallel: int = 16
+):
+    """Make the containers with ssh trust each other
+
+    The host keys are scanned concurrently, the content of known_hosts and authorized_keys
+    is built once in memory and pushed to the containers concurrently.
+    If changedHosts is provided, only these containers get the whole content, the others
+    have the entries of the changed hosts replaced.
+    """
     if sshkeyCacheInMem is not None:
         sshkeyCache = sshkeyCacheInMem
     else:
@@ -116,9 +395,7 @@ def build_ssh_trust_relationships(configList:list = None,  hosts:list = None, ss
     if containerCacheInMem is not None:
         containerCache = containerCacheInMem
     else:
-        containerCache = {}
-        for inst in client.containers.list(all = True):
-            containerCache[inst.name] = inst
+        containerCache = get_containers()
 
     # Populate sshkeyCache if hosts is not None
     shouldBuildSsh = True
@@ -148,83 +425,106 @@ def build_ssh_trust_relationships(configList:list = None,  hosts:list = None, ss
     if not shouldBuildSsh:
         return
 
-    if len(sshkeyCache.keys()) > 0 and shouldBuildSsh:
+    allHosts = list(sshkeyCache.keys())
+    if changedHosts is not None:
+        changedHosts = [host for host in allHosts if host in changedHosts]
+        if len(changedHosts) == 0:
+            print("ssh trust relationships are unchanged")
+            return
+        # every container is changed, all of them get the whole content
+        if len(changedHosts) == len(allHosts):
+            changedHosts = None
+    if len(allHosts) > 0:
         print("setting up ssh trust relationships")
-        # Prepare the host keys
-        tmpHostkeyFile = "./tmp-hostkeys.txt"
-        for host in sshkeyCache:
-            inst = containerCache[host]
-            # scan host keys
-            (exit_code, output) = inst.exec_run(
-                "ssh-keyscan -H {}".format(host),
-                stream = False
-            )
-            if exit_code == 0:
-                with open(tmpHostkeyFile, 'a') as f:
-                    f.write(output.decode("utf8"))
-            else:
-                errMsg = 'failed to scan host key for container {}'.format(host)
-                print(errMsg)
-                raise Exception(errMsg)
+        hostkeys = scan_host_keys(allHosts, containerCache, maxParallel)
+        knownHosts = ''.join([hostkeys[host] for host in allHosts])
+        keyLines = [sshkeyCache[host].strip() + '\n' for host in allHosts]
 
-        # spread ssh trust
-        tmpSshkeyFile = "./tmp-sshkeys.txt"
-        for hostX in sshkeyCache:
+        def push(hostX):
             inst = containerCache[hostX]
-            lines = []
-            for hostY in sshkeyCache:
-                if hostX != hostY:
-                    lines.append(sshkeyCache[hostY])
-            with open(tmpSshkeyFile, 'w') as f:
-                f.writelines(lines)
-            copy_to_container(inst, tmpSshkeyFile, '/root/.ssh/authorized_keys')
-            copy_to_container(inst, tmpHostkeyFile, '/root/.ssh/known_hosts')
-        os.remove(tmpSshkeyFile)
-        os.remove(tmpHostkeyFile)
+            if changedHosts is None or hostX in changedHosts:
+                authorizedKeys = ''.join([keyLines[i] for i in range(len(allHosts)) if allHosts[i] != hostX])
+                push_ssh_trust(inst, authorizedKeys, knownHosts)
+            else:
+                update_ssh_trust(
+                    inst,
+                    {host: sshkeyCache[host] for host in changedHosts},
+                    {host: hostkeys[host] for host in changedHosts}
+                )
+        tasks = {}
+        for host in allHosts:
+            tasks[host] = (lambda h: lambda: push(h))(host)
+        run_tasks(tasks, None, maxParallel)
         print("ssh trust relationships have been setup")
 
+envCache = {}
+envCacheLock = threading.Lock()
+
+def parse_env_variables(variables: list = None):
+    """Parse a list of 'NAME=value' strings to a dictionary, the value may contain '='
+    """
+    result = {}
+    if variables is None:
+        return result
+    for v in variables:
+        if v == '' or '=' not in v:
+            continue
+        (name, value) = v.split('=', 1)
+        result[name] = value
+    return result
+
 def get_existing_env_variables(container):
+    """Return the environment variables of the container from its inspect data,
+    cached by container id, so a recreated container is resolved again
+    """
     if container is None:
-        return []
+        return {}
 
-    (exit_code, output) = container.exec_run('env')
-    if exit_code != 0:
-        print(output.decode('utf8'))
-        raise Exception('Error when getting env from container [{}]'.format(container.name))
-    else:
-        variables = list(filter(lambda x: x!='', output.decode('utf8').split('\n')))
-        result = {}
-        for v in variables:
-            x = v.split('=')
-            result[x[0]] = x[1]
-        return result
+    with envCacheLock:
+        if container.id in envCache:
+            return envCache[container.id]
+    config = container.attrs.get("Config")
+    if config is None or "Env" not in config:
+        container.reload()
+        config = container.attrs.get("Config", {})
+    result = parse_env_variables(config.get("Env"))
+    with envCacheLock:
+        envCache[container.id] = result
+    return result
+
+def prepare_environment(container, environment: list = None):
+    """Return the environment variables for executing a command in the container,
+    PATH variables are joined and appended to the existing PATH of the container
+    """
+    env = []
+    PATH = ""
+    for var in environment or []:
+        x = var.split('=', 1)
+        if x[0] == 'PATH' and len(x) > 1:
+            if PATH == "":
+                PATH = x[1]
+            else:
+                PATH += ':' + x[1]
+        else:
+            env.append(var)
+    if PATH != "":
+        existingEnv = get_existing_env_variables(container)
+        if "PATH" not in existingEnv:
+            env.append('PATH={}'.format(PATH))
+        else:
+            env.append('PATH={}:{}'.format(existingEnv['PATH'], PATH))
+    return env
 
+@traced("exec_cmd", ["hostname", "cmd"])
 def exec_cmd(hostname:str = None, cmd: str = None, workdir: str = "/sardines/shoal", ignoreCmdErr: bool = False, environment: list = []):
     if not hostname or not cmd:
         return
 
     try:
-        inst = client.containers.get(hostname)
+        inst = get_container(hostname)
         if not inst:
             raise Exception('Can not find container instance [{}]'.format(hostname))
-        # Prepare environment variables
-        env = []
-        PATH = ""
-        for var in environment:
-            x = var.split('=')
-            if x[0] == 'PATH':
-                if PATH == "":
-                    PATH = x[1]
-                else:
-                    PATH += ':' + x[1]
-            else:
-                env.append(var)
-        if PATH != "":
-            existingEnv = get_existing_env_variables(inst)
-            if "PATH" not in existingEnv:
-                env.append('PATH={}'.format(PATH))
-            else:
-                env.append('PATH={}:{}'.format(existingEnv['PATH'], PATH))
+        env = prepare_environment(inst, environment)
         # Execute the command
         (exit_code, output) = inst.exec_run(
             cmd,
@@ -4,30 +4,49 @@
 # ./sardines.py --action deploy-services --repo-host nw-test-repo-1 --repo-deploy-plan deploy-repository.json --hosts nw-test-nginx-1 --application sardines-built-in-services --services /access_point/nginx:* --init-parameters ./sample_initParams/nginx_setup.json --tags test nginx
 #
 
-import docker
 import os
 import json
 import sys
 import time
+import atexit
 if __name__ == "__main__":
     from lib.utils import copy_to_container
     from lib.utils import exec_cmd
+    from lib.docker_client import get_containers
+    from lib.docker_client import get_container
+    from lib.command_runner import run_command
+    from lib.scheduler import print_with_prefix
+    from lib.tracing import traced
+    from lib.tracing import enable_tracing
+    from lib.tracing import write_trace
+    from lib.fanout import fan_out
+    from lib.fanout import exec_on_hosts
+    from lib.fanout import print_fanout_summary
+    from lib.fanout import write_fanout_report
+    from lib.fanout import fanout_failed
 else:
     from env.lib.utils import copy_to_container
     from env.lib.utils import exec_cmd
+    from env.lib.docker_client import get_containers
+    from env.lib.docker_client import get_container
+    from env.lib.command_runner import run_command
+    from env.lib.scheduler import print_with_prefix
+    from env.lib.tracing import traced
+    from env.lib.tracing import enable_tracing
+    from env.lib.tracing import write_trace
+    from env.lib.fanout import fan_out
+    from env.lib.fanout import exec_on_hosts
+    from env.lib.fanout import print_fanout_summary
+    from env.lib.fanout import write_fanout_report
+    from env.lib.fanout import fanout_failed
 
-client = docker.from_env()
-
+@traced("deploy_repository", ["hostname"])
 def deploy_repository(hostname: str = None, deployPlanFile: str = None, workdir:str = '/sardines/shoal', ignoreCmdErr: bool = False):
     try:
         beginTime = time.time()
-        print('preparing deploy repository, caching container instances...')
-        containerCache = {}
-        for inst in client.containers.list():
-            containerCache[inst.name] = inst
-        print('container instances have been cached')
+        containerCache = get_containers(running = True)
         if hostname is None or hostname not in containerCache:
-            raise Exception('target container {} does not exist'.format(hostanme))
+            raise Exception('target container {} does not exist'.format(hostname))
         if deployPlanFile is None or not os.path.exists(deployPlanFile):
             raise Exception('deploy plan file {} does not exist'.format(deployPlanFile))
         inst = containerCache[hostname]
@@ -59,49 +78,76 @@ def deploy_repository(hostname: str = None, deployPlanFile: str = None, workdir:
         print('Error while deploying repository on container {}:'.format(hostname), e)
         raise e
 
-def deploy_agent(agentHost: str = None, repoHost: str = None, workdir: str = "/sardines/shoal", ignoreCmdErr: bool = False):
+@traced("deploy_agent", ["agentHost", "repoHost"])
+def deploy_agent(
+    agentHost: str = None,
+    repoHost: str = None,
+    workdir: str = "/sardines/shoal",
+    ignoreCmdErr: bool = False,
+    retries: int = 0,
+    retryDelay: float = 5
+):
+    """Deploy agent on a container by running deploy_host.py on the repository host,
+    the output is printed with the agent hostname as prefix
+
+    retries: times to run deploy_host.py again if it failed, waiting retryDelay seconds
+             before the first retry and doubling the delay after each one
+
+    return the exit code of the last attempt
+    """
     try:
         beginTime = time.time()
-        print('preparing deploy repository, caching container instances...')
-        containerCache = {}
-        for inst in client.containers.list():
-            containerCache[inst.name] = inst
-        print('container instances have been cached')
-        if agentHost is None or agentHost not in containerCache:
+        agentInst = get_container(agentHost)
+        if agentHost is None or agentInst is None or agentInst.status != "running":
             raise Exception("invalid agent host {}".format(agentHost))
-        if repoHost is None or repoHost not in containerCache:
+        repoInst = get_container(repoHost)
+        if repoHost is None or repoInst is None or repoInst.status != "running":
             raise Exception("invalid repository host {}".format(repoHost))
 
-        print("begin deploying agent on container {} from the repository {}".format(agentHost, repoHost))
-        repoInst = containerCache[repoHost]
-        (exit_code, output) = repoInst.exec_run(
-            "./bin/deploy_host.py --repo-deploy-file ./deploy-repository.json --host-name {} --os-user root".format(agentHost),
-            stream = ignoreCmdErr,
-            workdir = workdir
-        )
+        print_with_prefix(agentHost, "begin deploying agent on container {} from the repository {}".format(agentHost, repoHost))
+        cmd = "./bin/deploy_host.py --repo-deploy-file ./deploy-repository.json --host-name {} --os-user root".format(agentHost)
+        result = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = retryDelay * (2 ** (attempt - 1))
+                print_with_prefix(agentHost, "retrying agent deployment in {} seconds ({}/{})".format(delay, attempt, retries))
+                time.sleep(delay)
+            result = run_command(repoInst, cmd, workdir, prefix = agentHost)
+            if result["exitCode"] == 0:
+                break
+            print_with_prefix(agentHost, "agent deployment on container {} failed, exit code: {}".format(agentHost, result["exitCode"]))
         endTime = time.time()
-        if not ignoreCmdErr and exit_code != 0 and exit_code is not None:
-            errMsg = "agent deployment on container {} failed, exit code: {}".format(agentHost, exit_code)
-            print(errMsg)
-            if type(output) == str:
-                print("ERROR of deploying agent:", output)
-            else:
-                print("ERROR of deploying agent:", output.decode("utf8"))
-            raise Exception(errMsg)
-        else:
-            if ignoreCmdErr:
-                for line in output:
-                    print(line.decode("utf8"))
-            elif type(output) == str:
-                print(output)
-            else:
-                print(output.decode("utf8"))
-            print("agent deployed on container {} in {} seconds".format(agentHost, round(endTime - beginTime,1)))
-            print("")
+        if result["exitCode"] != 0 and not ignoreCmdErr:
+            raise Exception("agent deployment on container {} failed, exit code: {}".format(agentHost, result["exitCode"]))
+        if result["exitCode"] == 0:
+            print_with_prefix(agentHost, "agent deployed on container {} in {} seconds".format(agentHost, round(endTime - beginTime,1)))
+        return result["exitCode"]
     except Exception as e:
         print('Error while deploying agent on container {}'.format(agentHost), e)
         raise e
 
+def deploy_agents(
+    agentHosts: list = None,
+    repoHost: str = None,
+    workdir: str = "/sardines/shoal",
+    ignoreCmdErr: bool = False,
+    maxParallel: int = 4,
+    retries: int = 2,
+    failFast: bool = False
+):
+    """Deploy agents on the containers concurrently, at most maxParallel deploy_host.py
+    processes are running on the repository host at the same time
+
+    return a dictionary of agent hostname and its result, see fan_out
+    """
+    return fan_out(
+        agentHosts,
+        lambda host: deploy_agent(host, repoHost, workdir, ignoreCmdErr = ignoreCmdErr, retries = retries),
+        maxParallel,
+        failFast
+    )
+
+@traced("deploy_service", ["repoHost", "application"])
 def deploy_service(
     repoDeployPlanFilePath: str = 'deploy-repository.json',
     repoHost: str = None,
@@ -116,10 +162,7 @@ def deploy_service(
     env: list = None,
     ):
 
-    containerCache = {}
-    for inst in client.containers.list():
-        containerCache[inst.name] = inst
-    print('container instances have been cached') 
+    containerCache = get_containers(running = True)
 
     hoststr = ''
     for host in targetHosts:
@@ -154,79 +197,128 @@ def deploy_service(
         environment = environment
     )
 
+def parse_service_specs(services: list = None):
+    """Parse service specs in the format of 'module:service[:version]' to a list of (module, service, version),
+    '*' or an omitted part means all
+    """
+    result = []
+    if services is None:
+        return result
+    for spec in services:
+        parts = spec.split(':')
+        if len(parts) < 2 or parts[0] == '':
+            print('invalid service spec [{}], which should be module:service[:version]'.format(spec))
+            continue
+        version = "*"
+        if len(parts) > 2 and parts[2] != '':
+            version = parts[2]
+        service = parts[1] if parts[1] != '' else '*'
+        result.append((parts[0], service, version))
+    return result
+
+def plan_service_runtime_removal(
+    applications: list = None,
+    targetHosts: list = None,
+    services: list = None,
+    tags: list = None
+):
+    """Build a removal plan, which is a list of removal items with applications, hosts, modules,
+    versions, services and tags, an empty list means all; service specs are merged into as few
+    items as possible
+    """
+    appList = [] if applications is None else [x for x in applications if x != '*']
+    hostList = [] if targetHosts is None else ['root@{}'.format(x) for x in targetHosts]
+    tagList = [] if tags is None else list(tags)
+
+    # module -> version -> services
+    moduleDict = {}
+    for (module, service, version) in parse_service_specs(services):
+        versionDict = moduleDict.setdefault(module, {})
+        serviceSet = versionDict.setdefault(version, set())
+        if service == '*':
+            serviceSet.add('*')
+        else:
+            serviceSet.add(service)
+
+    # merge modules with the same versions and services
+    groups = {}
+    for module in moduleDict:
+        for version in moduleDict[module]:
+            serviceSet = moduleDict[module][version]
+            serviceKey = () if '*' in serviceSet else tuple(sorted(serviceSet))
+            key = (serviceKey, version)
+            groups.setdefault(key, []).append(module)
+    merged = {}
+    for ((serviceKey, version), modules) in groups.items():
+        key = (serviceKey, tuple(sorted(modules)))
+        merged.setdefault(key, []).append(version)
+
+    plan = []
+    for ((serviceKey, modules), versions) in merged.items():
+        plan.append({
+            "applications": appList,
+            "hosts": hostList,
+            "modules": [] if '*' in modules else list(modules),
+            "versions": [] if '*' in versions else sorted(versions),
+            "services": list(serviceKey),
+            "tags": tagList
+        })
+    if len(plan) == 0:
+        plan.append({
+            "applications": appList,
+            "hosts": hostList,
+            "modules": [],
+            "versions": [],
+            "services": [],
+            "tags": tagList
+        })
+    return plan
+
+@traced("remove_service_runtimes", ["repoHost"])
 def remove_service_runtimes(
     repoDeployPlanFilePath: str = 'deploy-repository.json',
     repoHost: str = None,
     targetHosts: list = None,
-    application: str = None,
+    application = None,
     services: list = None,
     tags: list = None,
     ignoreCmdErr: bool = False,
     workdir: str = '/sardines/shoal',
     env: list = None,
     ):
-    hoststr = '*'
-    if targetHosts is not None and len(targetHosts) > 0:
-        hoststr = ''
-        for host in targetHosts:
-            hoststr += 'root@' + host + ','
-        hoststr = hoststr[0:-1]
-    
-    appstr = "*"
-    if application is not None and application != "*":
-        appstr = application
-    
-    versionDict = {}
-    if services is not None and len(services) > 0:
-        for service in services:
-            parts = service.split(':')[0]
-            if len(parts) < 2:
-                continue
-            version = "*"
-            if len(parts) > 2:
-                version = parts[2]
-            if version not in versionDict:
-                versionDict[version] = {}
-            moduleDict = versionDict[version]
-            moduleName = parts[0]
-            if moduleName not in moduleDict:
-                moduleDict[moduleName] = []
-            moduleServiceList = moduleDict[moduleName]
-            if parts[1] != '*' and parts[1] not in moduleServiceList:
-                moduleServiceList.append(parts[1])
-    
-    if len(versionDict.keys()) == 0:
-        versionDict['*'] = {}
-    
-    for version in versionDict.keys():
-        moduleDict = versionDict[version]
-        if len(moduleDict.keys()) == 0:
-            moduleDict["*"] = []
-        for module in moduleDict.keys():
-            moduleServiceList = moduleDict[module]
-            cmd = './lib/manager/manageRepository.js --remove-service-runtimes --applications={}'.format(appstr)
-            if module != '*':
-                cmd = '{} --modules={}'.format(cmd, module)
-            if version != "*":
-                cmd = '{} --versions={}'.format(cmd, version)
-            if len(moduleServiceList) > 0:
-                cmd = '{} --services={}'.format(cmd, ','.join(moduleServiceList))
-            if tags is not None and len(tags) > 0:
-                cmd = '{} --tags={}'.format(cmd, ','.join(tags))
-            if hoststr != '*':
-                cmd = '{} --hosts={}'.format(cmd, hoststr)
-            cmd = '{} {}'.format(cmd, repoDeployPlanFilePath)
-            environment = env
-            if env is None:
-                environment = ['PATH=./node_modules/.bin', 'PATH=./bin']
-            print('removing service runtimes using command:', cmd)
-            exec_cmd(
-                repoHost, 
-                cmd, 
-                ignoreCmdErr = ignoreCmdErr, 
-                workdir = workdir,
-                environment = environment
-            )
+    """Remove service runtimes on the target hosts, all of them are removed in one run on the repository host
+
+    application: an application name or a list of them
+    services: service specs in the format of 'module:service[:version]'
+    """
+    applications = application
+    if application is None or type(application) == str:
+        applications = [] if application is None else [application]
+    removalPlan = plan_service_runtime_removal(applications, targetHosts, services, tags)
+    print('removing service runtimes using plan:', json.dumps(removalPlan))
+
+    containerCache = get_containers(running = True)
+    if repoHost is None or repoHost not in containerCache:
+        raise Exception('repository host {} does not exist'.format(repoHost))
+    repoInst = containerCache[repoHost]
+    scriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', 'remove_service_runtimes.py')
+    timestamp = time.time()
+    targetScriptFile = '{}/deployments/remove_service_runtimes.py'.format(workdir)
+    targetPlanFile = '{}/deployments/removalPlan_{}.json'.format(workdir, timestamp)
+    exec_cmd(repoHost, 'mkdir -p {}/deployments'.format(workdir), ignoreCmdErr = ignoreCmdErr)
+    copy_to_container(repoInst, scriptFile, targetScriptFile, mode = "770")
+    copy_to_container(repoInst, json.dumps(removalPlan).encode('utf8'), targetPlanFile)
+
+    environment = env
+    if env is None:
+        environment = ['PATH=./node_modules/.bin', 'PATH=./bin']
+    exec_cmd(
+        repoHost,
+        '{} --removal-plan-file {} {}'.format(targetScriptFile, targetPlanFile, repoDeployPlanFilePath),
+        ignoreCmdErr = ignoreCmdErr,
+        workdir = workdir,
+        environment = environment
+    )
 
 # Executed from command line
 if __name__ == "__main__":
@@ -264,6 +356,13 @@ if __name__ == "__main__":
         required=False,
         help="application to be deployed if action = 'deploy-services' or action = 'remove-services'"
     )
+    argParser.add_argument(
+        "--applications",
+        nargs="+",
+        type=str,
+        required=False,
+        help="applications of which the service runtimes are removed if action = 'remove-service-runtimes', seperated by space"
+    )
     argParser.add_argument(
         "--services",
         nargs="+",
@@ -317,7 +416,47 @@ if __name__ == "__main__":
         default = False,
         help="if set true, will ignore any error on execution of commands"
     )
+    argParser.add_argument(
+        "--max-parallel",
+        type=int,
+        required=False,
+        default=4,
+        help="maximum number of hosts to perform action at the same time if action = 'exec-cmd' or action = 'deploy-agents'"
+    )
+    argParser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="do not start the action on more hosts once it failed on one of them, otherwise continue on error"
+    )
+    argParser.add_argument(
+        "--retries",
+        type=int,
+        required=False,
+        default=2,
+        help="times to retry the agent deployment on a host if it failed, if action = 'deploy-agents'"
+    )
+    argParser.add_argument(
+        "--timeout",
+        type=float,
+        required=False,
+        help="timeout in seconds of the command on each host if action = 'exec-cmd'"
+    )
+    argParser.add_argument(
+        "--report-file",
+        type=str,
+        required=False,
+        help="a json file to write the result of each host to if action = 'exec-cmd' or action = 'deploy-agents'"
+    )
+    argParser.add_argument(
+        "--trace-file",
+        type=str,
+        required=False,
+        help="a json file to write the spans of the functions and docker calls to, in Chrome trace event format"
+    )
     args = argParser.parse_args()
+    if args.trace_file is not None:
+        enable_tracing()
+        atexit.register(write_trace, args.trace_file)
 
     if args.action == "deploy-repo":
         if not args.repo_host:
@@ -329,8 +468,19 @@ if __name__ == "__main__":
             print("--repo-host is required")
             sys.exit(1)
         if args.hosts:
-            for host in args.hosts:
-                deploy_agent(host, args.repo_host, args.workdir, ignoreCmdErr = args.ignoreCmdErr)
+            results = deploy_agents(
+                args.hosts,
+                args.repo_host,
+                args.workdir,
+                args.ignoreCmdErr,
+                args.max_parallel,
+                args.retries,
+                args.fail_fast
+            )
+            print_fanout_summary(results, "agent deployment:")
+            write_fanout_report(results, args.report_file, {"action": args.action, "repoHost": args.repo_host})
+            if fanout_failed(results):
+                sys.exit(1)
             print("all agents have been deployed")
     elif args.action == 'deploy-services':
         if not args.application:
@@ -356,7 +506,7 @@ if __name__ == "__main__":
             args.repo_deploy_plan, 
             args.repo_host, 
             args.hosts, 
-            args.application, 
+            args.applications if args.applications else args.application, 
             args.services, 
             args.tags, 
             args.ignoreCmdErr,
@@ -365,8 +515,11 @@ if __name__ == "__main__":
         )
     elif args.action == "exec-cmd":
         if args.cmd and args.hosts:
-            for host in args.hosts:
-                exec_cmd(host, args.cmd, workdir = args.workdir, ignoreCmdErr = args.ignoreCmdErr, environment = args.env)
+            results = exec_on_hosts(args.hosts, args.cmd, args.workdir, args.env, args.max_parallel, args.fail_fast, args.timeout)
+            print_fanout_summary(results, "Command [{}]:".format(args.cmd))
+            write_fanout_report(results, args.report_file, {"action": args.action, "cmd": args.cmd, "workdir": args.workdir})
+            if fanout_failed(results) and not args.ignoreCmdErr:
+                sys.exit(1)
             print("Command [{}] has been executed on host [{}]".format(args.cmd, args.hosts))
     else:
         print('action [{}] is not supported'.format(args.action))
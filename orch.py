@@ -1,11 +1,35 @@
 #!/usr/bin/env python3
 from env.lib.network_builder import create_networks
 from env.lib.image_builder import build_images
-from env.lib.container_builder import build_containers
-from env.lib.db_builder import create_postgres_databases
+from env.lib.container_builder import plan_containers
+from env.lib.db_builder import plan_postgres_databases
 from env.sardines import deploy_repository
 from env.sardines import deploy_agent
 from env.lib.utils import exec_cmd
+from env.lib.scheduler import run_tasks
+from env.lib.scheduler import print_task_report
+from env.lib.readiness import wait_until_ready
+from env.lib.readiness import repository_probes
+from env.lib.readiness import process_probe
+from env.lib.tracing import enable_tracing
+from env.lib.tracing import write_trace
+from env.lib.telemetry import start_telemetry
+from env.lib.telemetry import stop_telemetry
+from env.lib.telemetry import add_phases
+from env.lib.telemetry import save_telemetry
+from env.lib.telemetry import print_telemetry_report
+from env.lib.benchmark import Phases
+from env.lib.benchmark import get_phase
+from env.lib.benchmark import summarize_timings
+from env.lib.benchmark import build_results
+from env.lib.benchmark import save_results
+from env.lib.benchmark import load_results
+from env.lib.benchmark import compare_with_baseline
+from env.lib.benchmark import print_benchmark_report
+from test.lib.load_generator import runLoad
+from test.lib.load_generator import printLoadReport
+import json
+import sys
 import time
 
 EnvLevels = ["infrastructure", "sardines", "services"]
@@ -20,9 +44,24 @@ def setupEnv(
     repoDeployFileList: list = None,
     repoHostList: list = None,
     agentHostList: list = None,
-    ignoreCmdErr: bool = False
+    ignoreCmdErr: bool = False,
+    maxParallel: int = 4,
+    readyTimeout: float = 180,
+    agentProcess: str = "node",
+    useCache: bool = True,
+    agentRetries: int = 2,
+    prebakedSsh: bool = False,
+    loadTest: dict = None,
+    phases: list = None
 ):
     """Only setup the environment for the future tests
+
+    All steps of the required levels are put in one task graph,
+    each host moves on as soon as its own prerequisites are done
+
+    phases: if provided, only the tasks of these phases are run, see benchmark.Phases
+
+    return the timings of the tasks, see scheduler.run_tasks
     """
     if level is None or level not in EnvLevels:
         raise Exception('illegal level {}'.format(level))
@@ -32,51 +71,96 @@ def setupEnv(
         skipIndex = EnvLevels.index(skipLevel)
 
     levelIndex = EnvLevels.index(level)
-    for step in range(len(EnvLevels)):
-        if step <= skipIndex:
-            continue
-        if step > levelIndex:
-            break
-        if step == 0:
-            create_networks(networkConfFile)
-            print('networks have been created')
-            build_images(imageConfFile)
-            print('images have been built')
-            build_containers(containerConfFile, ignoreCmdErr = ignoreCmdErr)
-            for dbConfFile in dbConfFileList:
-                create_postgres_databases(dbConfFile)
-            print('test envrionment has been set at [{}] level'.format(EnvLevels[step]))
-        elif step == 1:
-            print('begin to deploy repositories')
-            for i in range(min(len(repoDeployFileList), len(repoHostList))):
-                deploy_repository(repoHostList[i], repoDeployFileList[i], ignoreCmdErr = ignoreCmdErr)
-            print('begin to deploy agents')
-            for i in range(len(agentHostList)):
-                deploy_agent(agentHostList[i], repoHostList[0], ignoreCmdErr = ignoreCmdErr)
-            print('test envrionment has been set at [{}] level'.format(EnvLevels[step]))
-            pass
-        elif step == 2:
-            print('begin to deploy services')
-            if skipIndex < 1:
-                print('waiting the deployment of agents for 60 more seconds')
-                time.sleep(60)
-
-            for host in args.agent_hosts:
-                cmd = ''
-                if 'agent' in host:
-                    cmd = "deploy_service.py --repo-deploy-plan deploy-repository.json --hosts root@{} --application dietitian --tags test {}".format(host, host)
-                # elif 'nginx' in host:
-                #     cmd = "deploy_service.py --repo-deploy-plan deploy-repository.json --hosts root@{} --application sardines-built-in-services --services /access_point/nginx:* --tags test {}".format(host, host)
+    steps = [step for step in range(len(EnvLevels)) if step > skipIndex and step <= levelIndex]
+
+    tasks = {}
+    dependencies = {}
+    if 0 in steps:
+        tasks["networks"] = lambda: create_networks(networkConfFile)
+        tasks["images"] = lambda: build_images(imageConfFile, maxParallel = maxParallel)
+        (containerTasks, containerDependencies) = plan_containers(containerConfFile, ignoreCmdErr = ignoreCmdErr, useCache = useCache, prebakedSsh = prebakedSsh)
+        tasks.update(containerTasks)
+        dependencies.update(containerDependencies)
+        for name in containerTasks:
+            if name.startswith("container:"):
+                dependencies[name] = list(dependencies[name]) + ["networks", "images"]
+        (databaseTasks, databaseDependencies) = plan_postgres_databases(dbConfFileList, readyTimeout = readyTimeout)
+        tasks.update(databaseTasks)
+        dependencies.update(databaseDependencies)
+
+    if 1 in steps:
+        databaseTasks = [name for name in tasks if name.startswith("database:")]
+        for i in range(min(len(repoDeployFileList), len(repoHostList))):
+            taskName = "repository:{}".format(repoHostList[i])
+            tasks[taskName] = (lambda h, f: lambda: deploy_repository(h, f, ignoreCmdErr = ignoreCmdErr))(repoHostList[i], repoDeployFileList[i])
+            dependencies[taskName] = ["container:{}".format(repoHostList[i]), "commit:{}".format(repoHostList[i])] + databaseTasks
+        for host in agentHostList:
+            taskName = "agent:{}".format(host)
+            tasks[taskName] = (lambda h: lambda: deploy_agent(h, repoHostList[0], ignoreCmdErr = ignoreCmdErr, retries = agentRetries))(host)
+            dependencies[taskName] = [
+                "repository:{}".format(repoHostList[0]),
+                "container:{}".format(host),
+                "commit:{}".format(host),
+                "ssh-trust"
+            ]
+
+    if 2 in steps:
+        for host in agentHostList:
+            cmd = ''
+            if 'agent' in host:
+                cmd = "deploy_service.py --repo-deploy-plan deploy-repository.json --hosts root@{} --application dietitian --tags test {}".format(host, host)
+            # elif 'nginx' in host:
+            #     cmd = "deploy_service.py --repo-deploy-plan deploy-repository.json --hosts root@{} --application sardines-built-in-services --services /access_point/nginx:* --tags test {}".format(host, host)
+            if cmd == '':
+                continue
 
+            def deployServices(host = host, cmd = cmd):
+                probes = repository_probes(repoDeployFileList[0], repoHostList[0])
+                probes.append(process_probe(host, agentProcess))
+                wait_until_ready(probes, timeout = readyTimeout, name = 'agent on {}'.format(host))
                 exec_cmd(
-                    args.repo_hosts[0], 
-                    cmd, 
-                    ignoreCmdErr = args.ignoreCmdErr, 
+                    repoHostList[0],
+                    cmd,
+                    ignoreCmdErr = ignoreCmdErr,
                     environment = ['PATH=./node_modules/.bin', 'PATH=./bin']
                 )
-            print('test envrionment has been set at [{}] level'.format(EnvLevels[step]))
-        else:
-            pass
+            taskName = "services:{}".format(host)
+            tasks[taskName] = deployServices
+            dependencies[taskName] = ["agent:{}".format(host)]
+
+    # generate load on the services once everything else is set up
+    loadResults = []
+    if 2 in steps and loadTest is not None and len(loadTest["urls"]) > 0:
+        def generateLoad():
+            for url in loadTest["urls"]:
+                result = runLoad(
+                    url,
+                    loadTest["method"],
+                    loadTest["body"],
+                    None,
+                    loadTest["mode"],
+                    loadTest["concurrency"],
+                    loadTest["rate"],
+                    loadTest["duration"]
+                )
+                printLoadReport(result)
+                loadResults.append(result)
+            if loadTest["reportFile"] is not None:
+                with open(loadTest["reportFile"], 'w') as f:
+                    json.dump(loadResults, f, indent = 2)
+        tasks["load"] = generateLoad
+        dependencies["load"] = [name for name in tasks if name != "load"]
+
+    if phases is not None:
+        tasks = {name: tasks[name] for name in tasks if get_phase(name) in phases}
+
+    timings = {}
+    try:
+        run_tasks(tasks, dependencies, maxParallel, timings)
+    finally:
+        print_task_report(timings, dependencies)
+    print('test envrionment has been set at [{}] level'.format(level))
+    return timings
 
 
 if __name__ == '__main__':
@@ -155,21 +239,235 @@ if __name__ == '__main__':
         default=False,
         help="stop custom commands if an error occure, it's useful to turn off when debugging those commands"
     )
+    argParser.add_argument(
+        '--max-parallel',
+        type=int,
+        required=False,
+        default=4,
+        help="maximum number of tasks, such as building containers or deploying agents, to run at the same time"
+    )
+    argParser.add_argument(
+        '--ready-timeout',
+        type=float,
+        required=False,
+        default=180,
+        help="seconds to wait for the agents to be ready before deploying services"
+    )
+    argParser.add_argument(
+        '--agent-process',
+        type=str,
+        required=False,
+        default="node",
+        help="pattern of the agent process, which is used to check whether the agent is running"
+    )
+    argParser.add_argument(
+        '--agent-retries',
+        type=int,
+        required=False,
+        default=2,
+        help="times to retry the agent deployment on a host if it failed"
+    )
+    argParser.add_argument(
+        '--prebaked-ssh',
+        action='store_true',
+        required=False,
+        help="generate ssh keypairs of the containers on the host once and put them into the containers when building them"
+    )
+    argParser.add_argument(
+        '--load-urls',
+        nargs="+",
+        type=str,
+        required=False,
+        default=[],
+        help="urls to generate HTTP load on after the services are deployed, seperated by space"
+    )
+    argParser.add_argument(
+        '--load-method',
+        type=str,
+        required=False,
+        default="POST",
+        help="HTTP method of the load requests"
+    )
+    argParser.add_argument(
+        '--load-body',
+        type=str,
+        required=False,
+        default='{"msg":"xyz"}',
+        help="JSON body of the load requests"
+    )
+    argParser.add_argument(
+        '--load-mode',
+        type=str,
+        required=False,
+        default="closed",
+        choices=["closed", "open"],
+        help="closed or open loop load"
+    )
+    argParser.add_argument(
+        '--load-concurrency',
+        type=int,
+        required=False,
+        default=8,
+        help="number of keep-alive connections of the load"
+    )
+    argParser.add_argument(
+        '--load-rate',
+        type=float,
+        required=False,
+        help="requests per second of open loop load"
+    )
+    argParser.add_argument(
+        '--load-duration',
+        type=float,
+        required=False,
+        default=10,
+        help="seconds to generate load on each url"
+    )
+    argParser.add_argument(
+        '--load-report',
+        type=str,
+        required=False,
+        help="a json file to write the load results to"
+    )
+    argParser.add_argument(
+        '--no-cache',
+        action='store_true',
+        required=False,
+        help="rebuild all containers even if their configuration and sources are unchanged"
+    )
+    argParser.add_argument(
+        '--benchmark',
+        type=int,
+        required=False,
+        default=0,
+        help="run the orchestration this many times and record the durations of the phases, use it with --no-cache to measure full rebuilds"
+    )
+    argParser.add_argument(
+        '--benchmark-phases',
+        nargs="+",
+        type=str,
+        required=False,
+        choices=Phases,
+        help="phases to run in the benchmark, seperated by space: {}".format(', '.join(Phases))
+    )
+    argParser.add_argument(
+        '--benchmark-results',
+        type=str,
+        required=False,
+        default="benchmark-results.json",
+        help="a json file to write the benchmark results to"
+    )
+    argParser.add_argument(
+        '--benchmark-baseline',
+        type=str,
+        required=False,
+        help="a json file of previous benchmark results to compare with"
+    )
+    argParser.add_argument(
+        '--regression-threshold',
+        type=float,
+        required=False,
+        default=0.2,
+        help="a phase regresses if its median is slower than the baseline by more than this ratio"
+    )
+    argParser.add_argument(
+        '--trace-file',
+        type=str,
+        required=False,
+        help="a json file to write the spans of the tasks, functions and docker calls to, in Chrome trace event format"
+    )
+    argParser.add_argument(
+        '--telemetry-file',
+        type=str,
+        required=False,
+        help="a json file to write the cpu, memory, network and block IO samples of the containers to"
+    )
+    argParser.add_argument(
+        '--telemetry-interval',
+        type=float,
+        required=False,
+        default=1,
+        help="minimum seconds between two telemetry samples of a container"
+    )
     args = argParser.parse_args()
+    if args.trace_file is not None:
+        enable_tracing()
+
+    collector = None
+    if args.telemetry_file is not None:
+        hosts = None
+        if args.config_containers is not None:
+            with open(args.config_containers) as f:
+                hosts = [c["hostname"] for c in json.load(f) if "hostname" in c]
+        collector = start_telemetry(hosts, args.telemetry_interval)
+
+    runCount = [0]
+    def runSetup():
+        timings = setupEnv(
+            args.level,
+            args.skip_level,
+            args.config_networks,
+            args.config_images,
+            args.config_containers,
+            args.config_db,
+            args.config_repo,
+            args.repo_hosts,
+            args.agent_hosts,
+            args.ignoreCmdErr,
+            args.max_parallel,
+            args.ready_timeout,
+            args.agent_process,
+            not args.no_cache,
+            args.agent_retries,
+            args.prebaked_ssh,
+            {
+                "urls": args.load_urls,
+                "method": args.load_method,
+                "body": json.loads(args.load_body) if args.load_body else None,
+                "mode": args.load_mode,
+                "concurrency": args.load_concurrency,
+                "rate": args.load_rate,
+                "duration": args.load_duration,
+                "reportFile": args.load_report
+            },
+            args.benchmark_phases
+        )
+        runCount[0] += 1
+        if collector is not None:
+            add_phases(collector, timings, None if args.benchmark <= 1 else "run{}.".format(runCount[0]))
+        return timings
+
+    def runOrchestration():
+        if args.benchmark > 0:
+            baseline = load_results(args.benchmark_baseline)
+            runs = []
+            for i in range(args.benchmark):
+                print("benchmark run {}/{}".format(i + 1, args.benchmark))
+                runs.append(summarize_timings(runSetup()))
+            results = build_results(runs, args.benchmark_phases, {
+                "level": args.level,
+                "skipLevel": args.skip_level,
+                "maxParallel": args.max_parallel,
+                "useCache": not args.no_cache,
+                "prebakedSsh": args.prebaked_ssh
+            })
+            save_results(results, args.benchmark_results)
+            regressions = compare_with_baseline(results, baseline, args.regression_threshold)
+            print_benchmark_report(results, baseline, regressions)
+            if len(regressions) > 0:
+                sys.exit(1)
+        else:
+            runSetup()
 
     beginTime = time.time()
-    setupEnv(
-        args.level,
-        args.skip_level,
-        args.config_networks,
-        args.config_images,
-        args.config_containers,
-        args.config_db,
-        args.config_repo,
-        args.repo_hosts,
-        args.agent_hosts,
-        args.ignoreCmdErr
-    )
+    try:
+        runOrchestration()
+    finally:
+        write_trace(args.trace_file)
+        if collector is not None:
+            stop_telemetry(collector)
+            save_telemetry(collector, args.telemetry_file)
+            print_telemetry_report(collector)
     endTime = time.time()
     print("Job done in {} seconds".format(round(endTime - beginTime, 1)))
 
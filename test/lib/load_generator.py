@@ -0,0 +1,239 @@
+import asyncio
+import json
+import math
+import time
+from urllib.parse import urlsplit
+
+# number of significant digits kept by the latency histogram
+HistogramDigits = 3
+
+def newHistogram():
+    """return an empty latency histogram, latencies are recorded in microseconds
+    and rounded to HistogramDigits significant digits, like HDR histograms do
+    """
+    return {"counts": {}, "total": 0, "sum": 0, "max": 0}
+
+def recordLatency(histogram: dict = None, latency: float = None):
+    """record a latency in seconds
+    """
+    value = max(1, int(latency * 1000000))
+    digits = int(math.log10(value)) + 1
+    unit = 10 ** max(0, digits - HistogramDigits)
+    key = (value // unit) * unit
+    histogram["counts"][key] = histogram["counts"].get(key, 0) + 1
+    histogram["total"] += 1
+    histogram["sum"] += value
+    histogram["max"] = max(histogram["max"], value)
+
+def getPercentile(histogram: dict = None, percentile: float = None):
+    """return the latency in milliseconds at the percentile, such as 99.9
+    """
+    if histogram["total"] == 0:
+        return None
+    target = math.ceil(histogram["total"] * percentile / 100)
+    count = 0
+    for key in sorted(histogram["counts"].keys()):
+        count += histogram["counts"][key]
+        if count >= target:
+            return key / 1000
+    return histogram["max"] / 1000
+
+def parseUrl(url: str = None):
+    parts = urlsplit(url)
+    if parts.scheme != "http":
+        raise Exception('only http is supported by the load generator: {}'.format(url))
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return (parts.hostname, parts.port or 80, path)
+
+async def readResponse(reader = None):
+    """read a HTTP/1.1 response, return a tuple of (status, keepAlive)
+    """
+    statusLine = await reader.readline()
+    if not statusLine:
+        raise Exception('connection closed by the server')
+    status = int(statusLine.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, _, value) = line.decode('latin1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keepAlive = headers.get("connection", "").lower() != "close"
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif status not in (204, 304) and status >= 200:
+        await reader.read()
+        keepAlive = False
+    return (status, keepAlive)
+
+async def openConnection(host: str = None, port: int = None, timeout: float = None):
+    return await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+def buildRequest(method: str = None, host: str = None, port: int = None, path: str = None, body: bytes = None, headers: dict = None):
+    lines = [
+        '{} {} HTTP/1.1'.format(method, path),
+        'Host: {}:{}'.format(host, port),
+        'Connection: keep-alive',
+        'Content-Length: {}'.format(len(body or b''))
+    ]
+    for name in headers or {}:
+        lines.append('{}: {}'.format(name, headers[name]))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1') + (body or b'')
+
+async def runLoadAsync(
+    url: str = None,
+    method: str = "GET",
+    body = None,
+    headers: dict = None,
+    mode: str = "closed",
+    concurrency: int = 8,
+    rate: float = None,
+    duration: float = 10,
+    timeout: float = 5
+):
+    """drive the url with HTTP/1.1 keep-alive connections, at most concurrency connections are opened
+
+    mode: "closed" for each connection to send the next request once the response arrives,
+          "open" to send rate requests per second on schedule no matter how fast the responses are,
+          the latency is measured from the scheduled time, so the queueing delay is included
+
+    return a dictionary of the load result, see printLoadReport
+    """
+    (host, port, path) = parseUrl(url)
+    if type(body) == dict or type(body) == list:
+        body = json.dumps(body)
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "application/json")
+    if type(body) == str:
+        body = body.encode('utf8')
+    request = buildRequest(method, host, port, path, body, headers)
+    if mode == "open" and (rate is None or rate <= 0):
+        raise Exception('rate is required for open loop load')
+
+    histogram = newHistogram()
+    result = {
+        "url": url,
+        "method": method,
+        "mode": mode,
+        "concurrency": concurrency,
+        "rate": rate,
+        "requests": 0,
+        "errors": 0,
+        "statusCodes": {},
+        "errorTypes": {},
+        "connections": 0
+    }
+    idle = asyncio.Queue()
+    for i in range(concurrency):
+        idle.put_nowait(None)
+
+    async def send(scheduled):
+        conn = await idle.get()
+        try:
+            if conn is None:
+                conn = await openConnection(host, port, timeout)
+                result["connections"] += 1
+            (reader, writer) = conn
+            writer.write(request)
+            await writer.drain()
+            (status, keepAlive) = await asyncio.wait_for(readResponse(reader), timeout)
+            recordLatency(histogram, time.perf_counter() - scheduled)
+            result["requests"] += 1
+            result["statusCodes"][status] = result["statusCodes"].get(status, 0) + 1
+            if status >= 400:
+                result["errors"] += 1
+            if not keepAlive:
+                writer.close()
+                conn = None
+        except Exception as e:
+            result["requests"] += 1
+            result["errors"] += 1
+            errorType = type(e).__name__
+            result["errorTypes"][errorType] = result["errorTypes"].get(errorType, 0) + 1
+            if conn is not None:
+                conn[1].close()
+            conn = None
+        finally:
+            idle.put_nowait(conn)
+
+    beginTime = time.perf_counter()
+    endTime = beginTime + duration
+    if mode == "open":
+        pending = set()
+        i = 0
+        while True:
+            scheduled = beginTime + i / rate
+            if scheduled >= endTime:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.ensure_future(send(scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            i += 1
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+    else:
+        async def worker():
+            while time.perf_counter() < endTime:
+                await send(time.perf_counter())
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.perf_counter() - beginTime
+
+    while not idle.empty():
+        conn = idle.get_nowait()
+        if conn is not None:
+            conn[1].close()
+
+    result["duration"] = elapsed
+    result["throughput"] = result["requests"] / elapsed if elapsed > 0 else 0
+    result["errorRate"] = result["errors"] / result["requests"] if result["requests"] > 0 else 0
+    result["latency"] = {
+        "p50": getPercentile(histogram, 50),
+        "p90": getPercentile(histogram, 90),
+        "p99": getPercentile(histogram, 99),
+        "p999": getPercentile(histogram, 99.9),
+        "max": histogram["max"] / 1000 if histogram["total"] > 0 else None,
+        "mean": histogram["sum"] / histogram["total"] / 1000 if histogram["total"] > 0 else None
+    }
+    result["histogram"] = {str(k / 1000): v for (k, v) in sorted(histogram["counts"].items())}
+    return result
+
+def runLoad(*args, **kwargs):
+    """run runLoadAsync in a new event loop, see runLoadAsync for the arguments
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(runLoadAsync(*args, **kwargs))
+    finally:
+        loop.close()
+
+def printLoadReport(result: dict = None):
+    """print throughput, error rate and latency percentiles in milliseconds
+    """
+    print("")
+    print('load on {} {} ({} loop, concurrency {}{}):'.format(
+        result["method"], result["url"], result["mode"], result["concurrency"],
+        "" if result["rate"] is None else ", rate {}/s".format(result["rate"])
+    ))
+    print('    requests: {}, errors: {} ({}%), throughput: {} req/s in {} seconds, connections: {}'.format(
+        result["requests"], result["errors"], round(result["errorRate"] * 100, 2),
+        round(result["throughput"], 1), round(result["duration"], 1), result["connections"]
+    ))
+    print('    status codes: {}'.format(', '.join(['{}: {}'.format(k, v) for (k, v) in sorted(result["statusCodes"].items())])))
+    if len(result["errorTypes"]) > 0:
+        print('    errors: {}'.format(', '.join(['{}: {}'.format(k, v) for (k, v) in sorted(result["errorTypes"].items())])))
+    print('    latency (ms): ' + ', '.join([
+        '{}: {}'.format(k, "-" if result["latency"][k] is None else round(result["latency"][k], 3))
+        for k in ["p50", "p90", "p99", "p999", "max", "mean"]
+    ]))
@@ -1,11 +1,34 @@
 import os
 import json
 import asyncio
+import contextlib
+import weakref
 import aiopg
 
-async def connectDb(dbConfFile:str = None, user:str = None, password:str = None, host:str = "localhost", port:int = 5432, db:str = None, schema:str = "public"):
-    """create a connection string and return a db instance
+# queries prepared on each connection when they are used for the first time,
+# {schema} is replaced by the schema of the database configuration
+Statements = {
+    "selectOne": "SELECT 1",
+    "readyResources": "SELECT name FROM {schema}.resource WHERE status = 'ready' AND name = ANY($1)",
+    "resourceStatus": "SELECT name, status FROM {schema}.resource WHERE name = ANY($1)"
+}
+
+# pools by connection string, kept for the whole test session
+pools = {}
+poolsLock = None
+# names of the statements prepared on each connection
+preparedStatements = weakref.WeakKeyDictionary()
+# pools of the connections returned by connectDb
+connectionPools = weakref.WeakKeyDictionary()
+
+def loadDbConfig(dbConfFile:str = None, user:str = None, password:str = None, host:str = None, port:int = None, db:str = None, schema:str = "public"):
+    """return the database settings from the configuration file, or from the arguments,
+    host and port override the ones in the configuration file, such as when the database
+    is reached through a published port; they are localhost and 5432 by default
     """
+    if dbConfFile is None:
+        host = "localhost" if host is None else host
+        port = 5432 if port is None else port
     if dbConfFile is None and \
        (user is None or password is None or host is None or db is None or port is None):
         raise Exception('Invalid postgres connection request')
@@ -15,7 +38,7 @@ async def connectDb(dbConfFile:str = None, user:str = None, password:str = None,
 
     dbConf = {
         "host": host,
-        "port": user,
+        "port": port,
         "database": db,
         "schema": schema,
         "user": user,
@@ -28,19 +51,96 @@ async def connectDb(dbConfFile:str = None, user:str = None, password:str = None,
             or dbConf["type"] != "postgres" \
             or "settings" not in dbConf:
                 raise Exception("invalid database configuration file {}".format(dbConfFile))
-            dbConf = dbConf["settings"]
+            dbConf = dict(dbConf["settings"])
+            if host is not None:
+                dbConf["host"] = host
+            if port is not None:
+                dbConf["port"] = port
+    return dbConf
 
-    connStr = "dbname={database} user={user} password={password} host={host} port={port}".format(
+def getConnectionString(dbConf: dict = None):
+    return "dbname={database} user={user} password={password} host={host} port={port}".format(
         user = dbConf["user"],
         password = dbConf["password"],
-        host = "localhost",
+        host = dbConf["host"],
         port = dbConf["port"],
         database = dbConf["database"]
     )
+
+async def getPool(dbConfFile:str = None, minSize:int = 1, maxSize:int = 10, **kwargs):
+    """return the shared pool of the database and its schema, the pool is created on first use
+
+    kwargs: user, password, host, port, db and schema if dbConfFile is not provided
+    """
+    global poolsLock
+    dbConf = loadDbConfig(dbConfFile, **kwargs)
+    connStr = getConnectionString(dbConf)
+    if poolsLock is None:
+        poolsLock = asyncio.Lock()
+    async with poolsLock:
+        if connStr not in pools:
+            try:
+                pools[connStr] = (await aiopg.create_pool(connStr, minsize = minSize, maxsize = maxSize), dbConf["schema"])
+            except Exception as e:
+                print('Error while connecting to postgres database [{}@{}:{}/{}]'.format(
+                    dbConf["user"], dbConf["host"], dbConf["port"], dbConf["database"]
+                ), e)
+                raise e
+    return pools[connStr]
+
+@contextlib.asynccontextmanager
+async def acquireDb(dbConfFile:str = None, **kwargs):
+    """acquire a connection from the shared pool, it's released when leaving the context
+
+    usage: async with acquireDb(dbConfFile) as (conn, schema): ...
+    """
+    (pool, schema) = await getPool(dbConfFile, **kwargs)
+    conn = await pool.acquire()
     try:
-        pool = await aiopg.create_pool(connStr)
-        conn = await pool.acquire()
-        return (conn, dbConf["schema"])
-    except Exception as e:
-        print('Error while connecting to postgres database [{}]'.format(connStr), e)
-        raise e
+        yield (conn, schema)
+    finally:
+        pool.release(conn)
+
+async def executePrepared(conn = None, schema:str = None, name:str = None, params: tuple = ()):
+    """execute a statement in Statements, which is prepared on the connection when used for the first time,
+    return all rows
+    """
+    if name not in Statements:
+        raise Exception('unknown statement {}'.format(name))
+    if conn not in preparedStatements:
+        preparedStatements[conn] = set()
+    async with conn.cursor() as cur:
+        if name not in preparedStatements[conn]:
+            await cur.execute("PREPARE {} AS {}".format(name, Statements[name].format(schema = schema)))
+            preparedStatements[conn].add(name)
+        if len(params) > 0:
+            await cur.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(params))), params)
+        else:
+            await cur.execute("EXECUTE {}".format(name))
+        ret = []
+        async for row in cur:
+            ret.append(row)
+        return ret
+
+async def closePools():
+    """close all the shared pools, wait until their connections are closed
+    """
+    for connStr in list(pools.keys()):
+        (pool, _) = pools.pop(connStr)
+        pool.close()
+        await pool.wait_closed()
+
+async def connectDb(dbConfFile:str = None, user:str = None, password:str = None, host:str = None, port:int = None, db:str = None, schema:str = "public"):
+    """acquire a connection from the shared pool and return it with the schema,
+    release it by releaseDb
+    """
+    (pool, dbSchema) = await getPool(dbConfFile, user = user, password = password, host = host, port = port, db = db, schema = schema)
+    conn = await pool.acquire()
+    connectionPools[conn] = pool
+    return (conn, dbSchema)
+
+def releaseDb(conn = None):
+    """release a connection returned by connectDb
+    """
+    if conn in connectionPools:
+        connectionPools.pop(conn).release(conn)
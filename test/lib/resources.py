@@ -0,0 +1,50 @@
+import asyncio
+import time
+from lib.postgres import executePrepared
+
+async def checkResources(conn = None, schema:str = None, names: list = None):
+    """query the status of the resources in one statement
+
+    return a tuple of (ready, notReady, missing), ready and missing are sets of names,
+    notReady is a dictionary of name and its status
+    """
+    expected = set(names or [])
+    rows = await executePrepared(conn, schema, "resourceStatus", (list(expected),))
+    ready = set()
+    notReady = {}
+    for (name, status) in rows:
+        if status == 'ready':
+            ready.add(name)
+            notReady.pop(name, None)
+        elif name not in ready:
+            notReady[name] = status
+    missing = expected - ready - set(notReady.keys())
+    return (ready, notReady, missing)
+
+async def waitForResources(conn = None, schema:str = None, names: list = None, timeout: float = 0, initialDelay: float = 0.5, maxDelay: float = 5):
+    """check the resources until all of them are ready or the timeout is reached,
+    the delay between checks starts from initialDelay and is doubled up to maxDelay
+
+    return the result of checkResources at the last check
+    """
+    deadline = time.time() + (timeout or 0)
+    delay = initialDelay
+    while True:
+        (ready, notReady, missing) = await checkResources(conn, schema, names)
+        if len(notReady) == 0 and len(missing) == 0:
+            return (ready, notReady, missing)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return (ready, notReady, missing)
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, maxDelay)
+
+def describeResources(ready: set = None, notReady: dict = None, missing: set = None):
+    """return the lines describing the resources which are not ready
+    """
+    lines = []
+    for name in sorted(missing or []):
+        lines.append('Resource {} is missing'.format(name))
+    for name in sorted((notReady or {}).keys()):
+        lines.append('Resource {} is stuck in status {}'.format(name, notReady[name]))
+    return lines
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+from lib.load_generator import runLoad
+from lib.load_generator import printLoadReport
+import argparse
+import json
+import sys
+
+argparser = argparse.ArgumentParser(description="generate HTTP load on the deployed services")
+argparser.add_argument(
+    '--url',
+    nargs="+",
+    type=str,
+    required=False,
+    default=["http://172.20.20.131:8080/sardines-built-in-services/gateway/nginx/echo"],
+    help="urls to drive one after another, seperated by space"
+)
+argparser.add_argument(
+    '--method',
+    type=str,
+    required=False,
+    default="POST",
+    help="HTTP method of the requests"
+)
+argparser.add_argument(
+    '--body',
+    type=str,
+    required=False,
+    default='{"msg":"xyz"}',
+    help="JSON body of the requests, or @<file> to read it from a file"
+)
+argparser.add_argument(
+    '--mode',
+    type=str,
+    required=False,
+    default="closed",
+    choices=["closed", "open"],
+    help="closed loop sends the next request after the response, open loop sends --rate requests per second"
+)
+argparser.add_argument(
+    '--concurrency',
+    type=int,
+    required=False,
+    default=8,
+    help="number of keep-alive connections"
+)
+argparser.add_argument(
+    '--rate',
+    type=float,
+    required=False,
+    help="requests per second in open loop mode"
+)
+argparser.add_argument(
+    '--duration',
+    type=float,
+    required=False,
+    default=10,
+    help="seconds to generate load on each url"
+)
+argparser.add_argument(
+    '--timeout',
+    type=float,
+    required=False,
+    default=5,
+    help="seconds to wait for a response"
+)
+argparser.add_argument(
+    '--report-file',
+    type=str,
+    required=False,
+    help="a json file to write the results to"
+)
+argparser.add_argument(
+    '--max-error-rate',
+    type=float,
+    required=False,
+    default=0.01,
+    help="exit with error if the error rate of any url is higher"
+)
+args = argparser.parse_args()
+
+def execute():
+    body = args.body
+    if body is not None and body.startswith('@'):
+        with open(body[1:]) as f:
+            body = f.read()
+    results = []
+    for url in args.url:
+        result = runLoad(
+            url,
+            args.method,
+            json.loads(body) if body else None,
+            None,
+            args.mode,
+            args.concurrency,
+            args.rate,
+            args.duration,
+            args.timeout
+        )
+        printLoadReport(result)
+        results.append(result)
+    if args.report_file is not None:
+        with open(args.report_file, 'w') as f:
+            json.dump(results, f, indent = 2)
+    if any([r["errorRate"] > args.max_error_rate for r in results]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    execute()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-from lib.postgres import connectDb
+from lib.postgres import acquireDb
+from lib.postgres import executePrepared
+from lib.postgres import closePools
+from lib.resources import waitForResources
+from lib.resources import describeResources
 import argparse
 import asyncio
 
@@ -11,53 +15,58 @@ argparser.add_argument(
     required=True,
     help="test envrionment database configuration file"
 )
+argparser.add_argument(
+    '--db-host',
+    type=str,
+    required=False,
+    help="database host to connect to instead of the one in the configuration file, such as localhost"
+)
+argparser.add_argument(
+    '--db-port',
+    type=int,
+    required=False,
+    help="database port to connect to instead of the one in the configuration file"
+)
 argparser.add_argument(
     '--ready-resources',
     type=str,
     required=False,
     help="name of resources which should be ready in the resource table, seperate with ','"
 )
+argparser.add_argument(
+    '--ready-timeout',
+    type=float,
+    required=False,
+    default=0,
+    help="seconds to wait for the resources to be ready, they are checked only once by default"
+)
 args = argparser.parse_args()
 
 # Test and setup database connection
-async def test_db_conn():
+async def test_db_conn(conn = None, schema: str = None):
     print("")
     print('testing database connection')
-    (conn, schema) = await connectDb(args.config_db)
-    async with conn.cursor() as cur:
-        await cur.execute("SELECT 1")
-        ret = []
-        async for row in cur:
-            ret.append(row)
-        assert ret == [(1,)]
-        print('database connection is OK')
-        return (conn, schema)
+    ret = await executePrepared(conn, schema, "selectOne")
+    assert ret == [(1,)]
+    print('database connection is OK')
 
-async def test_resources(conn = None, schema: str = None, names: list = None):
+async def test_resources(conn = None, schema: str = None, names: list = None, timeout: float = 0):
     print("")
     print('testing resources')
-    async with conn.cursor() as cur:
-        await cur.execute("SELECT name from {}.resource where status = 'ready'".format(schema))
-        ret = []
-        async for row in cur:
-            ret.append(row[0])
-
-        for resource in names:
-            exists = False
-            for name in ret:
-                if name == resource:
-                    exists = True
-                    break
-            if not exists:
-                print('Resource {} is missing'.format(resource))
-                assert(exists)
-        print('resources all exist')
+    (ready, notReady, missing) = await waitForResources(conn, schema, names, timeout)
+    for line in describeResources(ready, notReady, missing):
+        print(line)
+    assert len(notReady) == 0 and len(missing) == 0
+    print('resources all exist')
 
 async def main():
-    (conn, schema) = await test_db_conn()
-    if args.ready_resources:
-        await test_resources(conn, schema, args.ready_resources.split(","))
-    conn.close()
+    try:
+        async with acquireDb(args.config_db, host = args.db_host, port = args.db_port) as (conn, schema):
+            await test_db_conn(conn, schema)
+            if args.ready_resources:
+                await test_resources(conn, schema, args.ready_resources.split(","), args.ready_timeout)
+    finally:
+        await closePools()
 
 def execute():
     loop = asyncio.get_event_loop()